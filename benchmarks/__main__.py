@@ -0,0 +1,228 @@
+"""
+Offline benchmarks for the lookup pipeline
+
+SauceNao, trace.moe and the image hosts are replaced with a local stub server, and Discord with fake contexts, so runs
+are reproducible and need no network access or API keys. Run from the repository root:
+
+    python -m benchmarks --iterations 200 --concurrency 10
+
+For load testing the ?sauce command as a whole, see benchmarks.load.
+"""
+import argparse
+import hashlib
+import io
+import itertools
+import json
+import shutil
+import tempfile
+import typing
+from time import time
+
+from benchmarks import harness
+from benchmarks.fakes import FakeChannel, FakeContext, FakeGuild, FakeMember, SendSink
+from benchmarks.stubs import StubUpstreams
+
+PROFILES = ('sqlite', 'mysql-like')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--iterations', type=int, default=200, help='Operations per benchmark')
+    parser.add_argument('-c', '--concurrency', type=int, default=10, help='Operations in flight at once')
+    parser.add_argument('--profiles', default=','.join(PROFILES),
+                        help=f"Comma separated database profiles to run ({', '.join(PROFILES)})")
+    parser.add_argument('--db-latency', type=float, default=0.001,
+                        help='Round trip in seconds added to every query by the mysql-like profile')
+    parser.add_argument('--latency', type=float, default=0.05, help='Mean upstream response time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='Maximum variation of the upstream response time')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of upstream requests that fail (0-1)')
+    # Anime results are left out, as building their embeds looks up ID mappings over the network
+    parser.add_argument('--results', choices=('booru', 'pixiv'), default='booru', help='SauceNao result type')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true',
+                        help="Don't measure peak memory; tracemalloc slows everything else down")
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to this file as JSON')
+    return parser.parse_args()
+
+
+class Suite:
+    """
+    Drives the Sauce cog, the cache and query log models and the trace.moe client against the stub upstreams
+    """
+
+    def __init__(self, args: argparse.Namespace, stub: StubUpstreams):
+        from saucebot.cogs.sauce import Sauce
+
+        self.args = args
+        self.stub = stub
+        self.results = []  # type: typing.List[harness.Result]
+        self.cog = Sauce()
+
+        self.sink = SendSink()
+        self.guild = FakeGuild()
+        self.channel = FakeChannel(self.guild, self.sink)
+        self.members = [FakeMember(f"Member {i}") for i in range(max(args.concurrency, 1))]
+
+        # Every cold lookup needs an image that has never been seen before, across all profiles
+        self._image_ids = itertools.count(1)
+
+    def context(self, i: int) -> FakeContext:
+        return FakeContext(self.guild, self.members[i % len(self.members)], self.channel)
+
+    async def measure(self, name: str, operation: typing.Callable[[int], typing.Awaitable],
+                      iterations: typing.Optional[int] = None) -> harness.Result:
+        result = await harness.run(name, operation, iterations or self.args.iterations, self.args.concurrency,
+                                   trace_memory=not self.args.no_memory)
+        self.results.append(result)
+        print(harness.table([result]).splitlines()[-1], flush=True)
+        return result
+
+    async def warm_up(self) -> None:
+        """
+        Start the image workers and open connections before anything is measured
+        """
+        for _ in range(max(self.args.concurrency, 1)):
+            await self.cog._get_sauce(self.context(0), self.stub.image_url(next(self._image_ids)))
+
+    async def lookups(self, profile: str) -> None:
+        urls = [self.stub.image_url(next(self._image_ids)) for _ in range(self.args.iterations)]
+
+        async def _get_sauce(i: int):
+            if not await self.cog._get_sauce(self.context(i), urls[i]):
+                raise LookupError('No results')
+
+        # Cold: nothing is cached, so every lookup downloads, hashes and downscales the image and queries SauceNao
+        await self.measure(f"{profile}: get_sauce cold", _get_sauce)
+        # Warm: the same images again, served from the in-memory result cache
+        await self.measure(f"{profile}: get_sauce warm (memory)", _get_sauce)
+        # Warm: and once more with the in-memory cache emptied, so results come from the database cache
+        self.cog._result_cache.clear()
+        await self.measure(f"{profile}: get_sauce warm (database)", _get_sauce)
+
+    async def models(self, profile: str, sauce) -> None:
+        from saucebot.models.database import SauceCache, SauceQueries
+
+        prefix = f"https://bench.invalid/{profile}/{time()}"
+
+        async def _add(i: int):
+            await SauceCache.add_or_update(f"{prefix}/{i}.png", sauce)
+
+        async def _fetch(i: int):
+            if not await SauceCache.fetch(f"{prefix}/{i}.png"):
+                raise LookupError('Cache miss')
+
+        batch_size = 100
+
+        async def _log_many(i: int):
+            rows = []
+            for j in range(batch_size):
+                url_hash = hashlib.md5(f"{prefix}/{i}/{j}".encode()).hexdigest()
+                member = self.members[j % len(self.members)]
+                rows.append({'server_id': self.guild.id, 'user_id': member.id, 'url_hash': url_hash,
+                             'queried': int(time())})
+            await SauceQueries.log_many(rows)
+
+        await self.measure(f"{profile}: SauceCache.add_or_update", _add)
+        await self.measure(f"{profile}: SauceCache.fetch", _fetch)
+        await self.measure(f"{profile}: SauceQueries.log_many ({batch_size} rows)", _log_many,
+                           max(self.args.iterations // 10, 1))
+
+    async def build_embed(self, sauce) -> None:
+        async def _build(i: int):
+            await self.cog._build_sauce_embed(self.context(i), sauce)
+
+        await self.measure('build_sauce_embed', _build)
+
+    async def tracemoe(self) -> None:
+        from saucebot.http import transport
+        from saucebot.imaging import image_pool
+        from saucebot.tracemoe import ATraceMoe
+
+        tracemoe = ATraceMoe(None, 'benchmark', session=transport.session(raise_for_status=True),
+                             max_edge=self.cog._upload_max_edge, quality=self.cog._upload_quality)
+        tracemoe.api_url = f"{self.stub.url}/api/"
+        tracemoe.media_url = f"{self.stub.url}/"
+
+        image = await self.cog._download_image(self.stub.image_url(0))
+        thumbnail = await image_pool.downscale(image, 1024)
+        response = await tracemoe.search(io.BytesIO(thumbnail))
+
+        async def _search(_: int):
+            await tracemoe.search(io.BytesIO(thumbnail))
+
+        async def _video_preview(_: int):
+            preview = await tracemoe.video_preview_natural(response)
+            preview.close()
+
+        await self.measure('ATraceMoe.search', _search)
+        await self.measure('ATraceMoe.video_preview_natural', _video_preview)
+
+    async def run(self, profiles: typing.List[str]) -> None:
+        from saucebot.models import database
+
+        print(harness.table([]), flush=True)
+        await self.warm_up()
+        sauce = await self.cog._get_sauce(self.context(0), self.stub.image_url(0))
+
+        default_executor = database._executor
+        for profile in profiles:
+            if profile == 'mysql-like':
+                database._executor = harness.LatencyExecutor(self.args.db_latency,
+                                                             max_workers=default_executor._max_workers,
+                                                             thread_name_prefix='saucebot-db-benchmark')
+            try:
+                await self.lookups(profile)
+                await self.models(profile, sauce)
+            finally:
+                if database._executor is not default_executor:
+                    database._executor.shutdown(wait=True)
+                    database._executor = default_executor
+
+        await self.build_embed(sauce)
+        await self.tracemoe()
+
+
+async def main(args: argparse.Namespace, profiles: typing.List[str]) -> typing.List[harness.Result]:
+    from saucebot.http import transport
+    from saucebot.imaging import image_pool
+    from saucebot.querylog import query_log
+    from saucebot.saucenao import PooledSauceNao
+
+    stub = StubUpstreams(args.latency, args.jitter, args.error_rate, args.results, seed=args.seed)
+    await stub.start()
+    PooledSauceNao.API_URL = f"{stub.url}/search.php"
+    query_log.start()
+
+    suite = Suite(args, stub)
+    try:
+        await suite.run(profiles)
+    finally:
+        await query_log.close()
+        await image_pool.close()
+        await transport.close()
+        await stub.close()
+
+    print(f"\nPeak RSS: {harness.max_rss() / 1048576:.1f} MiB")
+    print('Upstream requests: ' + ', '.join(f"{k}={v}" for k, v in sorted(stub.requests.items())))
+    return suite.results
+
+
+if __name__ == '__main__':
+    _args = parse_args()
+    _profiles = [p.strip() for p in _args.profiles.split(',') if p.strip()]
+    for _profile in _profiles:
+        if _profile not in PROFILES:
+            raise SystemExit(f"Unknown profile: {_profile}")
+
+    _directory = tempfile.mkdtemp(prefix='saucebot-benchmark-')
+    harness.configure(_directory)
+    try:
+        # SauceBot can only be imported once the database has been pointed at the scratch directory
+        from saucebot.bot import bot
+
+        _results = bot.loop.run_until_complete(main(_args, _profiles))
+        if _args.json:
+            with open(_args.json, 'w') as _fh:
+                json.dump([r.as_dict() for r in _results], _fh, indent=2)
+    finally:
+        shutil.rmtree(_directory, ignore_errors=True)
@@ -0,0 +1,147 @@
+import itertools
+import typing
+from collections import deque
+
+import discord
+
+# Discord snowflakes are unique across object types, so every fake draws its ID from the same sequence
+_ids = itertools.count(100000000000000000)
+
+
+class FakeGuild:
+    def __init__(self, name: str = 'Benchmark guild', filesize_limit: int = 8388608):
+        self.id = next(_ids)
+        self.name = name
+        self.filesize_limit = filesize_limit
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMember:
+    def __init__(self, display_name: str = 'Benchmark member'):
+        self.id = next(_ids)
+        self.name = display_name
+        self.display_name = display_name
+        self.mention = f"<@{self.id}>"
+
+    def __str__(self):
+        return self.display_name
+
+
+class SendSink:
+    """
+    Collects everything that would have been sent to Discord
+    """
+
+    def __init__(self, max_messages: typing.Optional[int] = None):
+        """
+        Args:
+            max_messages (typing.Optional[int]): Only keep this many of the most recent messages, so long runs don't
+                measure the sink's own memory growth
+        """
+        self.messages = deque(maxlen=max_messages)  # type: typing.Deque[dict]
+        self.sent = 0
+
+    def send(self, **kwargs) -> 'FakeMessage':
+        self.sent += 1
+        self.messages.append(kwargs)
+        return FakeMessage(content=kwargs.get('content') or '')
+
+    def clear(self) -> None:
+        self.messages.clear()
+
+
+class FakeChannel:
+    def __init__(self, guild: FakeGuild, sink: SendSink, name: str = 'benchmarks', nsfw: bool = False):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.nsfw = nsfw
+        self._sink = sink
+        self._history = deque(maxlen=50)  # type: typing.Deque[FakeMessage]
+
+    def post(self, message: 'FakeMessage') -> 'FakeMessage':
+        """
+        Add a message someone else posted to the channel history
+        """
+        self._history.append(message)
+        return message
+
+    async def history(self, limit: int = 100):
+        for message in list(reversed(self._history))[:limit]:
+            yield message
+
+    def is_nsfw(self) -> bool:
+        return self.nsfw
+
+    async def send(self, content: typing.Optional[str] = None, **kwargs) -> 'FakeMessage':
+        return self._sink.send(content=content, channel=self, **kwargs)
+
+
+class FakeAttachment:
+    def __init__(self, url: str):
+        self.id = next(_ids)
+        self.url = url
+        self.proxy_url = url
+        self.filename = url.rsplit('/', 1)[-1]
+
+
+class FakeReference:
+    def __init__(self, resolved: 'FakeMessage'):
+        self.resolved = resolved
+        self.message_id = resolved.id
+
+
+class FakeMessage(discord.Message):
+    """
+    A message that passes isinstance checks against discord.Message, as replies are only followed to real messages
+    """
+
+    # noinspection PyMissingConstructor
+    def __init__(self, content: str = '', author: typing.Optional[FakeMember] = None,
+                 channel: typing.Optional[FakeChannel] = None, attachments: typing.Optional[list] = None,
+                 reference: typing.Optional[FakeReference] = None):
+        self.id = next(_ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild if channel else None
+        self.attachments = attachments or []
+        self.embeds = []
+        self.reference = reference
+
+    def __repr__(self):
+        return f"<FakeMessage id={self.id}>"
+
+    async def delete(self) -> None:
+        pass
+
+    async def edit(self, **_) -> None:
+        pass
+
+    async def add_reaction(self, _) -> None:
+        pass
+
+
+class FakeContext:
+    """
+    Just enough of a commands.Context for the Sauce cog
+    """
+
+    def __init__(self, guild: FakeGuild, author: FakeMember, channel: FakeChannel,
+                 message: typing.Optional[FakeMessage] = None, command=None, bot=None):
+        self.guild = guild
+        self.author = author
+        self.channel = channel
+        self.message = message or FakeMessage(author=author, channel=channel)
+        self.command = command
+        self.bot = bot
+        self.replies = []  # type: typing.List[dict]
+
+    async def send(self, content: typing.Optional[str] = None, **kwargs) -> FakeMessage:
+        return await self.channel.send(content, **kwargs)
+
+    async def reply(self, content: typing.Optional[str] = None, **kwargs) -> FakeMessage:
+        self.replies.append(dict(kwargs, content=content))
+        return await self.channel.send(content, reply_to=self.message, **kwargs)
@@ -0,0 +1,189 @@
+import asyncio
+import gc
+import os
+import resource
+import sys
+import time
+import tracemalloc
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Result:
+    """
+    The outcome of a single benchmark
+    """
+
+    def __init__(self, name: str, latencies: typing.List[float], errors: int, elapsed: float, peak_memory: int):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+        self.peak_memory = peak_memory
+
+    @property
+    def operations(self) -> int:
+        return len(self.latencies) + self.errors
+
+    @property
+    def throughput(self) -> float:
+        return self.operations / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, percentile: float) -> float:
+        """
+        Nearest rank percentile of the successful operations
+        """
+        if not self.latencies:
+            return 0.0
+
+        rank = max(int(round(percentile / 100 * len(self.latencies))) - 1, 0)
+        return self.latencies[min(rank, len(self.latencies) - 1)]
+
+    def row(self) -> typing.List[str]:
+        return [
+            self.name, str(self.operations), str(self.errors), f"{self.throughput:.1f}",
+            f"{self.percentile(50) * 1000:.2f}", f"{self.percentile(99) * 1000:.2f}",
+            f"{self.peak_memory / 1048576:.1f}"
+        ]
+
+    def as_dict(self) -> dict:
+        return {
+            'name': self.name, 'operations': self.operations, 'errors': self.errors,
+            'throughput': self.throughput, 'p50': self.percentile(50), 'p99': self.percentile(99),
+            'peak_memory': self.peak_memory
+        }
+
+
+HEADERS = ['benchmark', 'ops', 'errors', 'ops/s', 'p50 ms', 'p99 ms', 'peak MiB']
+# Fixed minimum column widths, so rows printed one at a time as benchmarks finish still line up
+MIN_WIDTHS = [48, 6, 6, 9, 8, 8, 8]
+
+
+def table(results: typing.Iterable[Result]) -> str:
+    """
+    Render results as a plain text table
+    """
+    rows = [HEADERS] + [r.row() for r in results]
+    widths = [max([len(row[i]) for row in rows] + [MIN_WIDTHS[i]]) for i in range(len(HEADERS))]
+    lines = []
+    for i, row in enumerate(rows):
+        cells = [cell.ljust(w) if c == 0 else cell.rjust(w) for c, (cell, w) in enumerate(zip(row, widths))]
+        lines.append('  '.join(cells))
+        if i == 0:
+            lines.append('  '.join('-' * w for w in widths))
+
+    return '\n'.join(lines)
+
+
+async def run(name: str, operation: typing.Callable[[int], typing.Awaitable], iterations: int,
+              concurrency: int = 1, trace_memory: bool = True) -> Result:
+    """
+    Run an operation a number of times, with up to `concurrency` runs in flight at once
+    Args:
+        name (str): Name of the benchmark
+        operation (typing.Callable[[int], typing.Awaitable]): Called with the iteration number
+        iterations (int): Number of times to run the operation
+        concurrency (int): Maximum number of concurrent runs
+        trace_memory (bool): Measure peak memory with tracemalloc; this slows everything else down noticeably
+
+    Returns:
+        Result
+    """
+    latencies = []  # type: typing.List[float]
+    errors = 0
+    counter = iter(range(iterations))
+
+    async def _worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            # noinspection PyBroadException
+            try:
+                await operation(i)
+            except Exception:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[_worker() for _ in range(max(concurrency, 1))])
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+    finally:
+        tracemalloc.stop()
+
+    return Result(name, latencies, errors, elapsed, peak)
+
+
+def configure(directory: str, log_level: str = 'WARNING',
+              options: typing.Optional[typing.Dict[typing.Tuple[str, str], str]] = None) -> None:
+    """
+    Point SauceBot at a scratch SQLite database in the supplied directory
+    Must be called before anything other than saucebot.config is imported, as the database is bound on import.
+    Any configured MySQL server is ignored; a MySQL-like profile is simulated with LatencyExecutor instead.
+    Args:
+        directory (str): Directory to create the database in
+        log_level (str): Log level of the bot
+        options (typing.Optional[typing.Dict[typing.Tuple[str, str], str]]): Other (section, option) values to set
+    """
+    import saucebot.config
+    from saucebot.config import config
+
+    options = dict(options or {})
+    options[('Database', 'sqlite_filename')] = os.path.join(os.path.abspath(directory), 'benchmark.sqlite')
+    options[('Bot', 'log_level')] = log_level
+    options[('Bot', 'sentry_logging')] = 'false'
+    options[('Metrics', 'enabled')] = 'false'
+    # The stub upstreams serve images from the loopback address
+    options[('Imaging', 'allow_private_downloads')] = 'true'
+
+    config.remove_section('MySQL')
+    for (section, option), value in options.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, option, value)
+
+    # Derived from the configuration when saucebot.config is imported
+    saucebot.config.server_api_limit = int(config.get('SauceNao', 'server_api_limit', fallback=None) or 0)
+
+
+def current_rss() -> int:
+    """
+    Resident set size of this process in bytes, falling back to the peak where the current size is unavailable
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return max_rss()
+
+
+def max_rss() -> int:
+    """
+    Peak resident set size of this process in bytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class LatencyExecutor(ThreadPoolExecutor):
+    """
+    A database executor that adds a fixed round trip to every task
+    SQLite runs in process, so this approximates a database server on the network (MySQL) without needing one.
+    """
+
+    def __init__(self, round_trip: float, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_trip = round_trip
+
+    def submit(self, fn, *args, **kwargs):
+        def _delayed():
+            time.sleep(self.round_trip)
+            return fn(*args, **kwargs)
+
+        return super().submit(_delayed)
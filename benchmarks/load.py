@@ -0,0 +1,352 @@
+"""
+Load test for the ?sauce command
+
+Synthetic ?sauce traffic from many guilds is fed through Sauce.sauce at a configured rate, against the stub upstreams
+and an in-memory Discord. Commands arrive at random (Poisson) intervals, optionally with periodic bursts, and a share
+of them look up the same popular images. Tail latency (measured from when a command arrives, so time spent waiting
+for a free slot counts), the outcome of every command and memory growth over the run are reported. Run from the
+repository root:
+
+    python -m benchmarks.load --duration 60 --rate 20 --burst-rate 100 --burst-period 20 --burst-duration 5
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+import typing
+from collections import Counter, defaultdict
+
+from benchmarks import harness
+from benchmarks.fakes import FakeAttachment, FakeChannel, FakeContext, FakeGuild, FakeMember, FakeMessage, \
+    FakeReference, SendSink
+from benchmarks.stubs import StubUpstreams
+
+KINDS = ('attachment', 'reply', 'bare', 'url')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.load', description=__doc__.strip().splitlines()[0])
+    traffic = parser.add_argument_group('traffic')
+    traffic.add_argument('--duration', type=float, default=60.0, help='Seconds to generate traffic for')
+    traffic.add_argument('--rate', type=float, default=20.0, help='Commands per second')
+    traffic.add_argument('--burst-rate', type=float, default=0.0, help='Commands per second during bursts')
+    traffic.add_argument('--burst-period', type=float, default=30.0, help='Seconds between the start of each burst')
+    traffic.add_argument('--burst-duration', type=float, default=5.0, help='Seconds each burst lasts')
+    traffic.add_argument('-c', '--concurrency', type=int, default=100, help='Commands processed at once')
+    traffic.add_argument('--guilds', type=int, default=200)
+    traffic.add_argument('--members', type=int, default=20, help='Members per guild')
+    traffic.add_argument('--mix', default='attachment=0.5,reply=0.2,bare=0.2,url=0.1',
+                         help='Relative frequency of each way of using ?sauce')
+    traffic.add_argument('--duplicate-rate', type=float, default=0.3,
+                         help='Share of commands that look up one of the popular images (0-1)')
+    traffic.add_argument('--popular-images', type=int, default=20, help='Number of popular images')
+
+    limits = parser.add_argument_group('limits')
+    limits.add_argument('--member-limit', type=int, default=6, help='Member lookups every 5 minutes, 0 for no limit')
+    limits.add_argument('--guild-limit', type=int, default=0, help='Daily guild lookups, 0 for no limit')
+    limits.add_argument('--short-limit', type=int, default=0,
+                        help='SauceNao queries allowed every 30 seconds, 0 for no limit')
+    limits.add_argument('--daily-limit', type=int, default=0, help='SauceNao queries allowed in total, 0 for no limit')
+
+    upstream = parser.add_argument_group('upstreams')
+    upstream.add_argument('--latency', type=float, default=0.5, help='Mean upstream response time in seconds')
+    upstream.add_argument('--jitter', type=float, default=0.25, help='Maximum variation of the upstream response time')
+    upstream.add_argument('--error-rate', type=float, default=0.0, help='Share of upstream requests that fail (0-1)')
+    upstream.add_argument('--results', choices=('booru', 'pixiv'), default='booru', help='SauceNao result type')
+
+    parser.add_argument('--sample-interval', type=float, default=5.0, help='Seconds between memory samples')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Also sample Python heap usage with tracemalloc; this slows everything else down')
+    parser.add_argument('--log-level', default='CRITICAL',
+                        help="The bot's log level; errors are already counted in the outcomes")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to this file as JSON')
+    return parser.parse_args()
+
+
+def parse_mix(mix: str) -> typing.Dict[str, float]:
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        if kind.strip() not in KINDS:
+            raise SystemExit(f"Unknown command type in --mix: {kind}")
+        weights[kind.strip()] = float(weight)
+
+    return weights
+
+
+class LoadGenerator:
+    """
+    Issues ?sauce commands from fake guilds and members, recording how long each took and how it was answered
+    """
+
+    def __init__(self, args: argparse.Namespace, stub: StubUpstreams):
+        from saucebot.cogs.sauce import Sauce
+        from saucebot.lang import lang
+
+        self.args = args
+        self.stub = stub
+        self.cog = Sauce()
+        self.mix = parse_mix(args.mix)
+        self._random = random.Random(args.seed)
+
+        self.sink = SendSink(max_messages=100)
+        self.guilds = [FakeGuild(f"Guild {i}") for i in range(max(args.guilds, 1))]
+        self.channels = {g.id: FakeChannel(g, self.sink) for g in self.guilds}
+        self.members = {g.id: [FakeMember(f"Member {i}") for i in range(max(args.members, 1))] for g in self.guilds}
+
+        self.latencies = defaultdict(list)  # type: typing.Dict[str, typing.List[float]]
+        self.outcomes = Counter()  # type: typing.Counter[str]
+        self.in_flight = 0
+        self.samples = []  # type: typing.List[dict]
+
+        # The popular images come first; every other lookup is of an image nobody has seen before
+        self._fresh_images = itertools.count(max(args.popular_images, 0) + 1)
+        self._guild_limited = 0
+        self._slots = asyncio.Semaphore(max(args.concurrency, 1))
+
+        # Replies are classified by their embed descriptions
+        self._errors = {
+            lang('Sauce', key): key for key in ('member_api_limit_exceeded', 'api_limit_exceeded', 'no_images',
+                                                'bad_url', 'rejected_api_key', 'api_offline')
+        }
+        self._generic_error = lang('Global', 'generic_error')
+
+        # Refusals of the guild quota look the same as SauceNao's own limits to the member, so count them here
+        check_guild_quota = self.cog._check_guild_quota
+
+        async def _check_guild_quota(ctx) -> bool:
+            allowed = await check_guild_quota(ctx)
+            if not allowed:
+                self._guild_limited += 1
+            return allowed
+
+        self.cog._check_guild_quota = _check_guild_quota
+
+    def _image_url(self) -> str:
+        if self.args.popular_images and self._random.random() < self.args.duplicate_rate:
+            return self.stub.image_url(self._random.randint(1, self.args.popular_images))
+
+        return self.stub.image_url(next(self._fresh_images))
+
+    async def _command(self) -> typing.Tuple[str, FakeContext, typing.Optional[str]]:
+        """
+        Build a random ?sauce command, posting any messages it refers to first
+        Returns:
+            typing.Tuple[str, FakeContext, typing.Optional[str]]: The kind of command, its context and URL argument
+        """
+        kind = self._random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        guild = self._random.choice(self.guilds)
+        channel = self.channels[guild.id]
+        members = self.members[guild.id]
+        author, poster = self._random.sample(members, 2) if len(members) > 1 else (members[0], members[0])
+        url = self._image_url()
+
+        if kind == 'attachment':
+            message = FakeMessage('?sauce', author, channel, [FakeAttachment(url)])
+        elif kind == 'url':
+            message = FakeMessage(f"?sauce {url}", author, channel)
+        else:
+            # Replies and bare commands look up an image someone else posted
+            image_message = await self._post(FakeMessage('', poster, channel, [FakeAttachment(url)]))
+            reference = FakeReference(image_message) if kind == 'reply' else None
+            message = FakeMessage('?sauce', author, channel, reference=reference)
+
+        # The command message is only dispatched to the on_message listener once the command has started
+        channel.post(message)
+        return kind, FakeContext(guild, author, channel, message, self.cog.sauce), url if kind == 'url' else None
+
+    async def _post(self, message: FakeMessage) -> FakeMessage:
+        """
+        Post a message, dispatching it to the cog's on_message listener like the bot would
+        """
+        message.channel.post(message)
+        await self.cog.index_images(message)
+        return message
+
+    def _classify(self, ctx: FakeContext) -> str:
+        if not ctx.replies:
+            return 'no_reply'
+
+        embed = ctx.replies[-1].get('embed')
+        if embed is None:
+            return 'no_embed'
+
+        if embed.title == self._generic_error:
+            return self._errors.get(embed.description, 'error')
+
+        return 'found' if embed.url else 'not_found'
+
+    async def _invoke(self, kind: str, ctx: FakeContext, url: typing.Optional[str], arrived_at: float) -> None:
+        async with self._slots:
+            self.in_flight += 1
+            await self.cog.cog_before_invoke(ctx)
+            try:
+                # Like discord.py, the command is invoked before the message reaches the on_message listeners
+                command = asyncio.ensure_future(self.cog.sauce.callback(self.cog, ctx, url))
+                await asyncio.sleep(0)
+                await self.cog.index_images(ctx.message)
+                await command
+                outcome = self._classify(ctx)
+            except Exception as e:
+                outcome = f"exception ({type(e).__name__})"
+            finally:
+                await self.cog.cog_after_invoke(ctx)
+                self.in_flight -= 1
+
+        self.latencies[kind].append(time.perf_counter() - arrived_at)
+        self.outcomes[outcome] += 1
+
+    def rate(self, elapsed: float) -> float:
+        """
+        The command rate at a point in the run
+        """
+        if self.args.burst_rate and elapsed % self.args.burst_period < self.args.burst_duration:
+            return self.args.burst_rate
+
+        return self.args.rate
+
+    async def _sample(self, start: float, issued: int) -> None:
+        from saucebot.querylog import query_log
+
+        sample = {
+            'elapsed': time.perf_counter() - start, 'issued': issued, 'in_flight': self.in_flight,
+            'rss': harness.current_rss(), 'result_cache': len(self.cog._result_cache),
+            'thumbnails': len(self.cog._thumbnails), 'recent_images': len(self.cog._recent_images),
+            'member_limiter': len(self.cog._member_limiter) if not self.cog._shared_limits else 0,
+            'query_log': len(query_log._queue)
+        }
+        if self.args.trace_memory:
+            sample['heap'] = tracemalloc.get_traced_memory()[0]
+
+        self.samples.append(sample)
+        print(f"[{sample['elapsed']:6.1f}s] {issued} issued, {self.in_flight} in flight, "
+              f"RSS {sample['rss'] / 1048576:.1f} MiB" +
+              (f", heap {sample['heap'] / 1048576:.1f} MiB" if 'heap' in sample else ''), flush=True)
+
+    async def run(self) -> float:
+        """
+        Generate traffic for the configured duration, then wait for every command to finish
+        Returns:
+            float: Seconds from the first command to the last reply
+        """
+        tasks = set()  # type: typing.Set[asyncio.Task]
+        issued = 0
+        start = time.perf_counter()
+        next_sample = start
+        next_arrival = start
+
+        while next_arrival - start < self.args.duration:
+            now = time.perf_counter()
+            if now >= next_sample:
+                await self._sample(start, issued)
+                next_sample += self.args.sample_interval
+
+            if next_arrival > now:
+                await asyncio.sleep(min(next_arrival, next_sample) - now)
+                continue
+
+            kind, ctx, url = await self._command()
+            task = asyncio.ensure_future(self._invoke(kind, ctx, url, next_arrival))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            issued += 1
+
+            rate = self.rate(next_arrival - start)
+            next_arrival += self._random.expovariate(rate) if rate > 0 else self.args.duration
+
+        if tasks:
+            await asyncio.wait(tasks)
+
+        elapsed = time.perf_counter() - start
+        await self._sample(start, issued)
+        return elapsed
+
+    def report(self, elapsed: float) -> dict:
+        everything = [t for latencies in self.latencies.values() for t in latencies]
+        results = [harness.Result(k, self.latencies[k], 0, elapsed, 0) for k in KINDS if k in self.latencies]
+        results.append(harness.Result('all', everything, 0, elapsed, 0))
+
+        print()
+        print(harness.table(results))
+
+        print('\nTail latency (ms)')
+        for result in results:
+            tail = '  '.join(f"p{p:g} {result.percentile(p) * 1000:9.1f}" for p in (90, 99, 99.9))
+            print(f"  {result.name:<12} {tail}  max {result.percentile(100) * 1000:9.1f}")
+
+        print('\nOutcomes')
+        for outcome, count in self.outcomes.most_common():
+            print(f"  {outcome:<32} {count}")
+        print(f"  {'(refused by the guild quota)':<32} {self._guild_limited}")
+
+        print('\nUpstream requests')
+        for name, count in sorted(self.stub.requests.items()):
+            print(f"  {name:<32} {count}")
+
+        first, last = self.samples[0], self.samples[-1]
+        print('\nMemory')
+        print(f"  RSS {first['rss'] / 1048576:.1f} MiB -> {last['rss'] / 1048576:.1f} MiB "
+              f"(peak {harness.max_rss() / 1048576:.1f} MiB)")
+        if 'heap' in last:
+            print(f"  Python heap {first['heap'] / 1048576:.1f} MiB -> {last['heap'] / 1048576:.1f} MiB")
+        for name in ('result_cache', 'thumbnails', 'recent_images', 'member_limiter', 'query_log'):
+            print(f"  {name:<32} {first[name]} -> {last[name]}")
+
+        return {
+            'elapsed': elapsed,
+            'latency': {r.name: r.as_dict() for r in results},
+            'outcomes': dict(self.outcomes, guild_limited=self._guild_limited),
+            'upstream_requests': dict(self.stub.requests),
+            'samples': self.samples
+        }
+
+
+async def main(args: argparse.Namespace) -> dict:
+    from saucebot.http import transport
+    from saucebot.imaging import image_pool
+    from saucebot.querylog import query_log
+    from saucebot.saucenao import PooledSauceNao
+
+    stub = StubUpstreams(args.latency, args.jitter, args.error_rate, args.results, seed=args.seed,
+                         short_limit=args.short_limit, daily_limit=args.daily_limit)
+    await stub.start()
+    PooledSauceNao.API_URL = f"{stub.url}/search.php"
+    query_log.start()
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    generator = LoadGenerator(args, stub)
+    try:
+        return generator.report(await generator.run())
+    finally:
+        tracemalloc.stop()
+        await query_log.close()
+        await image_pool.close()
+        await transport.close()
+        await stub.close()
+
+
+if __name__ == '__main__':
+    _args = parse_args()
+    _directory = tempfile.mkdtemp(prefix='saucebot-load-')
+    harness.configure(_directory, _args.log_level, options={
+        ('SauceNao', 'member_api_limit'): str(_args.member_limit),
+        ('SauceNao', 'server_api_limit'): str(_args.guild_limit or '')
+    })
+    try:
+        # SauceBot can only be imported once the database has been pointed at the scratch directory
+        from saucebot.bot import bot
+
+        _report = bot.loop.run_until_complete(main(_args))
+        if _args.json:
+            with open(_args.json, 'w') as _fh:
+                json.dump(_report, _fh, indent=2)
+    finally:
+        shutil.rmtree(_directory, ignore_errors=True)
@@ -0,0 +1,202 @@
+import asyncio
+import io
+import random
+import typing
+from collections import Counter
+from time import monotonic
+
+from aiohttp import web
+from PIL import Image
+
+
+class StubUpstreams:
+    """
+    A local aiohttp server standing in for SauceNao, trace.moe and the image hosts lookups download from
+    Every response can be delayed, and a share of them can fail, to reproduce a slow or unreliable upstream.
+
+    Routes:
+        /search.php                     SauceNao API
+        /api/search                     trace.moe search API
+        /video/{anilist_id}/{filename}  trace.moe video previews
+        /images/{image_id}.png          Distinct, deterministic images, one per ID
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, error_rate: float = 0.0,
+                 results: str = 'booru', image_size: int = 512, preview_size: int = 524288, seed: int = 0,
+                 short_limit: int = 0, daily_limit: int = 0):
+        """
+        Args:
+            latency (float): Mean seconds each response is delayed by
+            jitter (float): Maximum seconds added to or removed from the latency
+            error_rate (float): Share of SauceNao and trace.moe requests (0-1) that fail
+            results (str): The type of SauceNao result returned; booru, pixiv or anime
+            image_size (int): Width and height of served images in pixels
+            preview_size (int): Size of served video previews in bytes
+            seed (int): Seed for the latency, errors and image contents
+            short_limit (int): SauceNao queries allowed every 30 seconds, 0 for no limit
+            daily_limit (int): SauceNao queries allowed in total, 0 for no limit
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.results = results
+        self.image_size = image_size
+        self.preview = b'\x00' * preview_size
+        self.short_limit = short_limit
+        self.daily_limit = daily_limit
+        self.requests = Counter()  # type: typing.Counter[str]
+
+        self._window_reset = 0.0
+        self._window_queries = 0
+        self._daily_queries = 0
+
+        self._random = random.Random(seed)
+        self._images = {}  # type: typing.Dict[int, bytes]
+        self._runner = None  # type: typing.Optional[web.AppRunner]
+        self.url = None  # type: typing.Optional[str]
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """
+        Start the server
+        Returns:
+            str: The base URL of the server
+        """
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route('*', '/search.php', self._saucenao)
+        app.router.add_route('*', '/api/search', self._tracemoe_search)
+        app.router.add_get('/video/{anilist_id}/{filename}', self._tracemoe_video)
+        app.router.add_get('/images/{image_id}.png', self._image)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def image_url(self, image_id: int) -> str:
+        return f"{self.url}/images/{image_id}.png"
+
+    async def _delay(self) -> None:
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _fail(self) -> bool:
+        return self._random.random() < self.error_rate
+
+    async def _saucenao(self, request: web.Request) -> web.Response:
+        self.requests['saucenao'] += 1
+        await request.read()
+        await self._delay()
+
+        if self._fail():
+            return web.json_response({'header': {'status': -1, 'message': 'Stub error'}}, status=500)
+
+        # Queries are counted against the limits the way SauceNao does, including those that are rejected
+        now = monotonic()
+        if self._window_reset <= now:
+            self._window_reset = now + 30.0
+            self._window_queries = 0
+
+        self._window_queries += 1
+        self._daily_queries += 1
+        if self.daily_limit and self._daily_queries > self.daily_limit:
+            self.requests['saucenao_daily_limited'] += 1
+            return self._limited('Daily Search Limit Exceeded.')
+
+        if self.short_limit and self._window_queries > self.short_limit:
+            self.requests['saucenao_short_limited'] += 1
+            return self._limited('Search Rate Too High. You have exceeded the searches every 30 seconds limit.')
+
+        short_limit = self.short_limit or 200
+        long_limit = self.daily_limit or 5000
+        header = {
+            'user_id': '1', 'account_type': '2', 'short_limit': str(short_limit), 'long_limit': str(long_limit),
+            'long_remaining': max(long_limit - self._daily_queries, 0) if self.daily_limit else long_limit - 1,
+            'short_remaining': max(short_limit - self._window_queries, 0) if self.short_limit else short_limit - 1,
+            'status': 0, 'results_requested': '6', 'search_depth': '128', 'minimum_similarity': 50.0,
+            'results_returned': 1
+        }
+        return web.json_response({'header': header, 'results': [self._saucenao_result()]})
+
+    @staticmethod
+    def _limited(message: str) -> web.Response:
+        return web.json_response({'header': {'status': -1, 'message': message}}, status=429)
+
+    def _saucenao_result(self) -> dict:
+        similarity = f"{self._random.uniform(60, 98):.2f}"
+        if self.results == 'anime':
+            return {
+                'header': {'similarity': similarity, 'thumbnail': f"{self.url}/images/0.png", 'index_id': 21,
+                           'index_name': 'Index #21: Anime - stub.mp4'},
+                'data': {'ext_urls': ['https://anidb.net/anime/1'], 'source': 'Stub Anime', 'anidb_aid': 1,
+                         'part': '1', 'year': '2020', 'est_time': '00:01:00 / 00:24:00'}
+            }
+
+        if self.results == 'pixiv':
+            return {
+                'header': {'similarity': similarity, 'thumbnail': f"{self.url}/images/0.png", 'index_id': 5,
+                           'index_name': 'Index #5: Pixiv Images - stub.jpg'},
+                'data': {'ext_urls': ['https://www.pixiv.net/member_illust.php?mode=medium&illust_id=1'],
+                         'title': 'Stub illustration', 'pixiv_id': 1, 'member_name': 'Stub artist', 'member_id': 1}
+            }
+
+        return {
+            'header': {'similarity': similarity, 'thumbnail': f"{self.url}/images/0.png", 'index_id': 9,
+                       'index_name': 'Index #9: Danbooru - stub.jpg'},
+            'data': {'ext_urls': ['https://danbooru.donmai.us/post/show/1'], 'danbooru_id': 1,
+                     'creator': 'stub artist', 'material': 'stub series', 'characters': 'stub character',
+                     'source': 'https://www.pixiv.net/member_illust.php?mode=medium&illust_id=1'}
+        }
+
+    async def _tracemoe_search(self, request: web.Request) -> web.Response:
+        self.requests['tracemoe_search'] += 1
+        await request.read()
+        await self._delay()
+
+        if self._fail():
+            raise web.HTTPServiceUnavailable()
+
+        return web.json_response({
+            'RawDocsCount': 1, 'RawDocsSearchTime': 10, 'ReRankSearchTime': 10, 'CacheHit': False, 'trial': 1,
+            'limit': 100, 'limit_ttl': 60, 'quota': 1000, 'quota_ttl': 86400,
+            'docs': [{
+                'from': 60.0, 'to': 62.0, 'anilist_id': 1, 'at': 61.0, 'season': '2020-01', 'anime': 'Stub Anime',
+                'filename': 'stub.mp4', 'episode': 1, 'tokenthumb': 'stub', 'similarity': 0.95, 'title': 'Stub',
+                'title_native': 'Stub', 'title_chinese': 'Stub', 'title_english': 'Stub', 'title_romaji': 'Stub',
+                'mal_id': 1, 'synonyms': [], 'synonyms_chinese': [], 'is_adult': False
+            }]
+        })
+
+    async def _tracemoe_video(self, _: web.Request) -> web.Response:
+        self.requests['tracemoe_video'] += 1
+        await self._delay()
+        return web.Response(body=self.preview, content_type='video/mp4')
+
+    async def _image(self, request: web.Request) -> web.Response:
+        self.requests['image'] += 1
+        image_id = int(request.match_info['image_id'])
+        if image_id not in self._images:
+            self._images[image_id] = self._render_image(image_id)
+
+        return web.Response(body=self._images[image_id], content_type='image/png')
+
+    def _render_image(self, image_id: int) -> bytes:
+        """
+        Random noise seeded by the image ID, so every ID has its own (perceptual) hash
+        """
+        pixels = random.Random(image_id)
+        block = Image.frombytes('L', (16, 16), bytes(pixels.getrandbits(8) for _ in range(256)))
+        image = block.resize((self.image_size, self.image_size), Image.NEAREST).convert('RGB')
+
+        output = io.BytesIO()
+        image.save(output, format='PNG')
+        return output.getvalue()
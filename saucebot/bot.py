@@ -1,8 +1,52 @@
+import asyncio
+import logging
+import os
+import typing
+
 from discord.ext import commands
 
+from saucebot.cluster import ENV_SHARD_COUNT, ENV_SHARD_IDS
 from saucebot.config import config
 
-bot = commands.AutoShardedBot(
+
+class SauceBot(commands.AutoShardedBot):
+    """
+    AutoShardedBot with support for cleanup tasks that run when the bot shuts down
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shutdown_hooks = []  # type: typing.List[typing.Callable[[], typing.Awaitable]]
+        self._shutdown_complete = False
+
+    def add_shutdown_hook(self, hook: typing.Callable[[], typing.Awaitable]) -> None:
+        """
+        Register a coroutine function to be awaited when the bot shuts down
+        Hooks run after we disconnect from Discord, in the reverse order they were registered.
+        """
+        self._shutdown_hooks.append(hook)
+
+    async def close(self):
+        await super().close()
+        if self._shutdown_complete:
+            return
+
+        self._shutdown_complete = True
+        for hook in reversed(self._shutdown_hooks):
+            # A hook failing, or being cancelled (discord.py cancels every task when interrupted), must never stop
+            # the hooks after it from running
+            # noinspection PyBroadException
+            try:
+                await hook()
+            except (Exception, asyncio.CancelledError):
+                logging.getLogger(__name__).exception(f"Shutdown hook {hook} raised an exception")
+
+
+# When running as part of a cluster, the supervisor tells each worker process which shards it owns
+_shard_ids = os.environ.get(ENV_SHARD_IDS)
+bot = SauceBot(
     command_prefix=[p.strip() for p in str(config.get('Bot', 'command_prefixes', fallback='?')).split(',')],
     case_insensitive=True,
+    shard_ids=[int(i) for i in _shard_ids.split(',')] if _shard_ids else None,
+    shard_count=int(os.environ[ENV_SHARD_COUNT]) if _shard_ids else None,
 )
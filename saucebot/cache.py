@@ -0,0 +1,232 @@
+import typing
+from collections import OrderedDict, deque
+from time import monotonic
+
+from saucebot import metrics
+
+
+class LRUCache:
+    """
+    A bounded, in-memory least recently used cache where entries also expire after a fixed time-to-live
+    """
+
+    def __init__(self, name: str, max_size: int = 1024, ttl: float = 3600.0):
+        """
+        Args:
+            name (str): Name of the cache, used to label its metrics
+            max_size (int): Maximum number of entries held before the least recently used entry is evicted
+            ttl (float): Number of seconds an entry remains valid for
+        """
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # type: OrderedDict[typing.Hashable, typing.Tuple[float, typing.Any]]
+
+        self.hits = metrics.counter('saucebot_cache_hits_total', 'Cache hits', cache=name)
+        self.misses = metrics.counter('saucebot_cache_misses_total', 'Cache misses', cache=name)
+        self.evictions = metrics.counter('saucebot_cache_evictions_total', 'Cache evictions', cache=name)
+        self._size = metrics.gauge('saucebot_cache_entries', 'Number of cached entries', cache=name)
+
+    def get(self, key: typing.Hashable, default=None):
+        """
+        Get a cached value, refreshing its position in the LRU order
+        Args:
+            key (typing.Hashable):
+            default: Returned when no valid entry exists
+
+        Returns:
+            The cached value, or the default
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses.inc()
+            return default
+
+        expires_at, value = entry
+        if expires_at <= monotonic():
+            del self._entries[key]
+            self._size.set(len(self._entries))
+            self.misses.inc()
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits.inc()
+        return value
+
+    def set(self, key: typing.Hashable, value) -> None:
+        """
+        Cache a value, evicting the least recently used entry if the cache is full
+        """
+        if not self.max_size:
+            return
+
+        self._entries[key] = (monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions.inc()
+
+        self._size.set(len(self._entries))
+
+    def pop(self, key: typing.Hashable, default=None):
+        """
+        Remove an entry from the cache
+        """
+        entry = self._entries.pop(key, None)
+        self._size.set(len(self._entries))
+        return entry[1] if entry else default
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._size.set(0)
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        The ratio of lookups that were served from the cache
+        """
+        total = self.hits.value + self.misses.value
+        return self.hits.value / total if total else 0.0
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > monotonic()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RecentImageIndex:
+    """
+    Keeps a small ring buffer of the most recently posted images for each channel
+    Channels that haven't seen a new image within the idle timeout are forgotten, as are the least recently active
+    channels once the maximum number of channels is reached.
+    """
+
+    def __init__(self, max_channels: int = 10000, per_channel: int = 5, idle_timeout: float = 3600.0):
+        """
+        Args:
+            max_channels (int): Maximum number of channels to index
+            per_channel (int): Number of image posts remembered per channel
+            idle_timeout (float): Seconds after a channels last image post before it is forgotten
+        """
+        self.max_channels = max_channels
+        self.per_channel = per_channel
+        self.idle_timeout = idle_timeout
+        # channel ID -> (last update, deque of (message ID, image URLs))
+        self._channels = OrderedDict()  # type: OrderedDict[int, typing.Tuple[float, typing.Deque]]
+
+        self.hits = metrics.counter('saucebot_cache_hits_total', 'Cache hits', cache='recent_images')
+        self.misses = metrics.counter('saucebot_cache_misses_total', 'Cache misses', cache='recent_images')
+        self.evictions = metrics.counter('saucebot_cache_evictions_total', 'Cache evictions', cache='recent_images')
+        self._size = metrics.gauge('saucebot_cache_entries', 'Number of cached entries', cache='recent_images')
+
+    def add(self, channel_id: int, message_id: int, urls: typing.List[str]) -> None:
+        """
+        Index the images from a newly posted message
+        """
+        if not self.max_channels:
+            return
+
+        entry = self._channels.pop(channel_id, None)
+        posts = entry[1] if entry else deque(maxlen=self.per_channel)
+        posts.append((message_id, urls))
+        self._channels[channel_id] = (monotonic(), posts)
+
+        while len(self._channels) > self.max_channels:
+            self._channels.popitem(last=False)
+            self.evictions.inc()
+
+        self._size.set(len(self._channels))
+
+    def latest(self, channel_id: int) -> typing.Optional[typing.List[str]]:
+        """
+        Get the image URLs from the most recent image post in a channel
+        Returns:
+            typing.Optional[typing.List[str]]: None if we have no record of recent images in this channel
+        """
+        entry = self._channels.get(channel_id)
+        if not entry or not entry[1] or entry[0] + self.idle_timeout <= monotonic():
+            self.misses.inc()
+            return None
+
+        self.hits.inc()
+        return entry[1][-1][1]
+
+    def remove(self, channel_id: int, message_ids: typing.Iterable[int]) -> None:
+        """
+        Forget deleted messages
+        """
+        entry = self._channels.get(channel_id)
+        if not entry:
+            return
+
+        message_ids = set(message_ids)
+        posts = entry[1]
+        for post in [p for p in posts if p[0] in message_ids]:
+            posts.remove(post)
+
+    def sweep(self) -> int:
+        """
+        Forget channels that have been idle for longer than the idle timeout
+        Returns:
+            int: The number of channels forgotten
+        """
+        cutoff = monotonic() - self.idle_timeout
+        idle = [channel_id for channel_id, (updated, _) in self._channels.items() if updated <= cutoff]
+        for channel_id in idle:
+            del self._channels[channel_id]
+
+        self.evictions.inc(len(idle))
+        self._size.set(len(self._channels))
+        return len(idle)
+
+    def __len__(self):
+        return len(self._channels)
+
+
+class GuildMetadataCache:
+    """
+    Holds every guild's registered API key and the guild banlist in memory
+    Both are tiny and change only through owner / administrator commands, so they are loaded in full and then kept
+    up to date as they are changed, with an optional periodic reload to pick up changes made by other processes.
+    """
+
+    def __init__(self):
+        self._api_keys = {}  # type: typing.Dict[int, str]
+        self._banned = frozenset()  # type: typing.FrozenSet[int]
+        self.loaded = False
+
+        self._size = metrics.gauge('saucebot_cache_entries', 'Number of cached entries', cache='guild_metadata')
+
+    def load(self, api_keys: typing.Dict[int, str], banned: typing.Iterable[int]) -> None:
+        """
+        Replace the cached metadata with a fresh copy from the database
+        Args:
+            api_keys (typing.Dict[int, str]): Registered API keys, keyed by guild ID
+            banned (typing.Iterable[int]): ID's of banned guilds
+        """
+        self._api_keys = dict(api_keys)
+        self._banned = frozenset(banned)
+        self.loaded = True
+        self._size.set(len(self._api_keys) + len(self._banned))
+
+    def api_key(self, guild_id: int) -> typing.Optional[str]:
+        return self._api_keys.get(guild_id)
+
+    def set_api_key(self, guild_id: int, api_key: typing.Optional[str]) -> None:
+        if api_key:
+            self._api_keys[guild_id] = api_key
+        else:
+            self._api_keys.pop(guild_id, None)
+
+        self._size.set(len(self._api_keys) + len(self._banned))
+
+    def is_banned(self, guild_id: int) -> bool:
+        return guild_id in self._banned
+
+    def set_banned(self, guild_id: int, banned: bool) -> None:
+        # The set is replaced rather than mutated, as database workers update it from other threads
+        self._banned = self._banned | {guild_id} if banned else self._banned - {guild_id}
+        self._size.set(len(self._api_keys) + len(self._banned))
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import typing
+from multiprocessing.connection import wait
+from time import monotonic, sleep
+
+import discord
+
+# Environment variables used to hand each worker process its shards
+ENV_CLUSTER_ID = 'SAUCEBOT_CLUSTER_ID'
+ENV_SHARD_IDS = 'SAUCEBOT_SHARD_IDS'
+ENV_SHARD_COUNT = 'SAUCEBOT_SHARD_COUNT'
+
+_log = logging.getLogger(__name__)
+
+
+def shard_ranges(shard_count: int, processes: int) -> typing.List[typing.List[int]]:
+    """
+    Split shards into contiguous, evenly sized ranges, one per process
+    Args:
+        shard_count (int): Total number of shards
+        processes (int): Number of worker processes
+
+    Returns:
+        typing.List[typing.List[int]]: The shard ID's owned by each process
+    """
+    processes = max(min(processes, shard_count), 1)
+    size, remainder = divmod(shard_count, processes)
+    ranges, start = [], 0
+    for i in range(processes):
+        end = start + size + (1 if i < remainder else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+
+    return ranges
+
+
+async def recommended_shard_count(token: str) -> int:
+    """
+    Ask Discord how many shards the bot should be running
+    """
+    http = discord.http.HTTPClient()
+    try:
+        await http.static_login(token, bot=True)
+        shard_count, _ = await http.get_bot_gateway()
+        return shard_count
+    finally:
+        await http.close()
+
+
+def _run_worker(cluster_id: int, shard_ids: typing.List[int], shard_count: int, token: str) -> None:
+    """
+    Entry point of a worker process
+    """
+    os.environ[ENV_CLUSTER_ID] = str(cluster_id)
+    os.environ[ENV_SHARD_IDS] = ','.join(map(str, shard_ids))
+    os.environ[ENV_SHARD_COUNT] = str(shard_count)
+
+    # The bot reads its shards from the environment when it is created, so it must not be imported until now.
+    # Client.run closes the bot cleanly when the supervisor stops us with SIGTERM.
+    from saucebot.saucebot import bot
+    bot.run(token)
+
+
+class Worker:
+    """
+    A worker process and the shards it owns
+    """
+
+    def __init__(self, cluster_id: int, shard_ids: typing.List[int]):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process = None  # type: typing.Optional[multiprocessing.Process]
+        self.started_at = 0.0
+        self.restarts = 0
+        self.restart_at = None  # type: typing.Optional[float]
+
+    @property
+    def name(self) -> str:
+        return f"cluster-{self.cluster_id} (shards {self.shard_ids[0]}-{self.shard_ids[-1]})"
+
+
+class ClusterSupervisor:
+    """
+    Runs the bot as several worker processes, each connected to its own range of shards
+    Workers that exit unexpectedly are restarted, with an increasing delay if they keep crashing shortly after
+    starting. State that must be consistent between workers (caches, guild quotas and, optionally, member rate limits)
+    lives in the database.
+    """
+    STABLE_AFTER = 300.0
+    MAX_RESTART_DELAY = 300.0
+
+    def __init__(self, token: str, processes: int, shard_count: int = 0, restart_delay: float = 5.0):
+        """
+        Args:
+            token (str): The bot token
+            processes (int): Number of worker processes to run
+            shard_count (int): Total number of shards, or 0 to use the number Discord recommends
+            restart_delay (float): Seconds to wait before restarting a crashed worker
+        """
+        self.token = token
+        self.processes = processes
+        self.shard_count = shard_count
+        self.restart_delay = restart_delay
+        self.workers = []  # type: typing.List[Worker]
+        self._context = multiprocessing.get_context('spawn')
+        self._stopping = False
+
+    def _start(self, worker: Worker) -> None:
+        worker.process = self._context.Process(
+                target=_run_worker, name=worker.name,
+                args=(worker.cluster_id, worker.shard_ids, self.shard_count, self.token)
+        )
+        worker.process.start()
+        worker.started_at = monotonic()
+        worker.restart_at = None
+        _log.info(f"[CLUSTER] Started {worker.name} as process {worker.process.pid}")
+
+    def _schedule_restart(self, worker: Worker) -> None:
+        # Back off exponentially when a worker keeps crashing, but start over once it has been running for a while
+        if monotonic() - worker.started_at >= self.STABLE_AFTER:
+            worker.restarts = 0
+
+        delay = min(self.restart_delay * (2 ** worker.restarts), self.MAX_RESTART_DELAY)
+        worker.restarts += 1
+        worker.restart_at = monotonic() + delay
+        _log.error(f"[CLUSTER] {worker.name} exited with code {worker.process.exitcode}; restarting in {delay:.0f}s")
+
+    def stop(self, *_) -> None:
+        self._stopping = True
+
+    def run(self) -> None:
+        """
+        Start the workers and supervise them until interrupted
+        """
+        if not self.shard_count:
+            self.shard_count = asyncio.get_event_loop().run_until_complete(recommended_shard_count(self.token))
+
+        self.workers = [Worker(i, shards) for i, shards in enumerate(shard_ranges(self.shard_count, self.processes))]
+        _log.info(f"[CLUSTER] Running {self.shard_count} shard(s) across {len(self.workers)} process(es)")
+
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        for worker in self.workers:
+            self._start(worker)
+
+        try:
+            while not self._stopping:
+                sentinels = [w.process.sentinel for w in self.workers if w.restart_at is None]
+                if sentinels:
+                    wait(sentinels, timeout=1.0)
+                else:
+                    sleep(1.0)
+
+                for worker in self.workers:
+                    if worker.restart_at is None and not worker.process.is_alive():
+                        self._schedule_restart(worker)
+                    elif worker.restart_at is not None and worker.restart_at <= monotonic() and not self._stopping:
+                        self._start(worker)
+        finally:
+            self._shutdown()
+
+    def _shutdown(self, timeout: float = 30.0) -> None:
+        """
+        Ask every worker to close cleanly, killing any that don't within the timeout
+        """
+        _log.info('[CLUSTER] Shutting down')
+        running = [w.process for w in self.workers if w.process and w.process.is_alive()]
+        for process in running:
+            process.terminate()
+
+        deadline = monotonic() + timeout
+        while any(p.is_alive() for p in running) and monotonic() < deadline:
+            sleep(0.5)
+
+        for process in running:
+            if process.is_alive():
+                _log.warning(f"[CLUSTER] {process.name} did not shut down in time; killing it")
+                process.kill()
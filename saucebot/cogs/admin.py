@@ -1,13 +1,17 @@
 import asyncio
+import io
 import logging
+import threading
 import typing
+from datetime import datetime
 
 import discord
 from discord.ext import commands
 
 from saucebot.helpers import basic_embed
 from saucebot.lang import lang
-from saucebot.models.database import GuildBanlist
+from saucebot.models.database import GuildBanlist, guild_metadata
+from saucebot.monitoring import loop_lag_monitor, sample_stacks
 
 
 class Admin(commands.Cog):
@@ -56,7 +60,7 @@ class Admin(commands.Cog):
             await ctx.send(lang('Admin', 'guild_404'))
 
         # Make sure it's not already banned
-        if GuildBanlist.check(guild):
+        if guild_metadata.is_banned(guild_id):
             await ctx.send(lang('Admin', 'gban_already_banned'), delete_after=15.0)
             return
 
@@ -78,7 +82,7 @@ class Admin(commands.Cog):
         finally:
             await confirm_message.delete()
 
-        GuildBanlist.ban(guild, reason)
+        await GuildBanlist.ban(guild, reason)
 
         # Send the guild owner a ban message
         try:
@@ -99,15 +103,41 @@ class Admin(commands.Cog):
         Removed a specified guild from the bots banlist
         """
         # Make sure the guild has actually been banned
-        if not GuildBanlist.check(guild_id):
+        if not guild_metadata.is_banned(guild_id):
             await ctx.send(lang('Admin', 'gban_not_banned'), delete_after=15.0)
             return
 
         self._log.warning(f"Removing guild {guild_id} from the guild banlist")
-        GuildBanlist.unban(guild_id)
+        await GuildBanlist.unban(guild_id)
 
         await ctx.send(lang('Admin', 'gban_unban_success'))
 
+    @commands.command()
+    @commands.is_owner()
+    async def profile(self, ctx: commands.Context, seconds: float = 10.0):
+        """
+        Samples what the event loop spends its time on and uploads the results, along with any recently recorded
+        slow callbacks
+        """
+        seconds = min(max(seconds, 1.0), 60.0)
+        await ctx.send(lang('Admin', 'profile_started', {'seconds': seconds}))
+
+        # Sampling runs in another thread, so the loop carries on as normal while we profile it
+        samples = await ctx.bot.loop.run_in_executor(None, sample_stacks, threading.get_ident(), seconds)
+
+        report = io.StringIO()
+        total = sum(samples.values())
+        for stack, count in samples.most_common():
+            report.write(f"{count} ({count / total:.1%}) {stack}\n")
+
+        if loop_lag_monitor.slow_callbacks:
+            report.write("\nRecent slow callbacks:\n")
+            for timestamp, lag, stack in loop_lag_monitor.slow_callbacks:
+                report.write(f"\n{datetime.utcfromtimestamp(timestamp).isoformat()} blocked for {lag:.3f}s\n{stack}")
+
+        await ctx.send(lang('Admin', 'profile_complete', {'samples': total}),
+                       file=discord.File(io.BytesIO(report.getvalue().encode('utf-8')), filename='profile.txt'))
+
     @commands.Cog.listener('on_guild_join')
     async def refuse_banned_invites(self, guild: discord.Guild):
         """
@@ -120,6 +150,6 @@ class Admin(commands.Cog):
             None
         """
         self._log.info(f"Verifying whether or not guild {guild.name} ({guild.id}) has been banned")
-        if GuildBanlist.check(guild):
+        if guild_metadata.is_banned(guild.id):
             self._log.warning(f"Banned guild {guild.name} ({guild.id}) attempted to re-invite the bot")
             await guild.leave()
@@ -1,6 +1,5 @@
 import logging
 from datetime import datetime
-from time import time
 
 import discord
 from discord.ext import commands
@@ -8,24 +7,7 @@ from discord.ext import commands
 from saucebot.bot import bot
 from saucebot.helpers import basic_embed
 from saucebot.lang import lang
-from saucebot.models.database import SauceQueries
-
-
-def maintain_stats(function):
-    """
-    Recounts the guild statistics
-    """
-    def wrapper(self, statistic: str):
-        if time() < self._recache_stats_at:
-            return function(self, statistic)
-
-        self._stats_cache['guild_count'] = len(bot.guilds)
-        self._stats_cache['user_count'] = len([member for member in bot.get_all_members()])  # Not accurate without privileged  intents
-        self._stats_cache['query_count'] = SauceQueries.count_total() or 0
-        self._recache_stats_at = time() + 900
-        return function(self, statistic)
-
-    return wrapper
+from saucebot.stats import stats
 
 
 class Misc(commands.Cog):
@@ -34,14 +16,6 @@ class Misc(commands.Cog):
     """
     def __init__(self):
         self._log = logging.getLogger(__name__)
-        self._recache_stats_at = 0  # Recache guild/member counts every 15 minutes
-        self._stats_cache = {
-            'guild_count': 0,
-            'user_count': 0,
-            'query_count': 0,
-        }
-        self._guild_count = 0
-        self._user_count = 0
 
     @commands.command()
     async def ping(self, ctx: commands.Context):
@@ -101,9 +75,35 @@ class Misc(commands.Cog):
         )
         await ctx.reply(embed=embed)
 
-    @maintain_stats
-    def get_stat(self, statistic: str):
+    def get_stat(self, statistic: str) -> int:
+        """
+        Get the current value of a bot statistic
+        """
+        return stats.get(statistic)
+
+    @commands.Cog.listener('on_ready')
+    async def count_guilds(self):
         """
-        Get the number of guilds the bot is in
+        Take a full count of our guilds and their members; from here on they are maintained incrementally
         """
-        return self._stats_cache[statistic]
+        stats.set('guild_count', len(bot.guilds))
+        stats.set('user_count', sum(guild.member_count or 0 for guild in bot.guilds))
+
+    @commands.Cog.listener('on_guild_join')
+    async def count_guild_join(self, guild: discord.Guild):
+        stats.increment('guild_count')
+        stats.increment('user_count', guild.member_count or 0)
+
+    @commands.Cog.listener('on_guild_remove')
+    async def count_guild_remove(self, guild: discord.Guild):
+        stats.increment('guild_count', -1)
+        stats.increment('user_count', -(guild.member_count or 0))
+
+    # Member events are only received with the privileged members intent
+    @commands.Cog.listener('on_member_join')
+    async def count_member_join(self, member: discord.Member):
+        stats.increment('user_count')
+
+    @commands.Cog.listener('on_member_remove')
+    async def count_member_remove(self, member: discord.Member):
+        stats.increment('user_count', -1)
@@ -1,27 +1,50 @@
 import asyncio
+import io
+import ipaddress
 import logging
 import re
 import reprlib
 import typing
-from io import BytesIO
+from time import perf_counter
 
+import aiohttp
 import discord
 import pysaucenao
+import yarl
 from discord.embeds import EmptyEmbed
 from discord.ext import commands
 from pysaucenao import DailyLimitReachedException, GenericSource, InvalidImageException, InvalidOrWrongApiKeyException, \
-    MangaSource, SauceNao, SauceNaoException, ShortLimitReachedException, VideoSource
+    MangaSource, SauceNaoException, ShortLimitReachedException, VideoSource
 from pysaucenao.containers import ACCOUNT_ENHANCED, AnimeSource, BooruSource
 
 import saucebot.assets
+from saucebot import metrics
 from saucebot.bot import bot
+from saucebot.cache import LRUCache, RecentImageIndex
 from saucebot.config import config, server_api_limit
+from saucebot.files import SharedFile
 from saucebot.helpers import basic_embed, keycap_emoji, keycap_to_int, reaction_check, validate_url
+from saucebot.http import is_public_address, transport
+from saucebot.imaging import ImageProcessingError, image_pool, is_distinctive
 from saucebot.lang import lang
-from saucebot.models.database import SauceCache, SauceQueries, Servers
+from saucebot.maintenance import scheduler
+from saucebot.models.database import GuildQuotas, SauceCache, SauceHashCache, SauceQueries, Servers, \
+    guild_metadata
+from saucebot.querylog import query_log
+from saucebot.ratelimit import DatabaseLimiter, SlidingWindowLimiter
+from saucebot.saucenao import SauceNaoPool
+from saucebot.singleflight import SingleFlight
+from saucebot.stats import stats
 from saucebot.tracemoe import ATraceMoe
 
 
+def _stage(name: str):
+    """
+    Time a stage of the lookup pipeline
+    """
+    return metrics.timer('saucebot_lookup_stage_seconds', 'Time spent in each stage of a lookup', stage=name)
+
+
 # noinspection PyMethodMayBeStatic
 class Sauce(commands.Cog):
     """
@@ -29,6 +52,7 @@ class Sauce(commands.Cog):
     """
 
     IMAGE_URL_RE = re.compile(r"^https?://\S+(\.jpg|\.png|\.jpeg|\.webp)$")
+    MAX_REDIRECTS = 5
 
     def __init__(self):
         self._log = logging.getLogger(__name__)
@@ -36,16 +60,80 @@ class Sauce(commands.Cog):
         self._re_api_key = re.compile(r"^[a-zA-Z0-9]{40}$")
         self.tracemoe = None
 
-        bot.loop.create_task(self.purge_cache())
+        # SauceNao clients are reused between lookups, one per API key
+        self._saucenao = SauceNaoPool(bot.loop, transport.session(),
+                                      min_similarity=float(config.get('SauceNao', 'min_similarity', fallback=50.0)),
+                                      priority=[21, 22, 5, 37, 25],
+                                      queue_timeout=config.getfloat('SauceNao', 'queue_timeout', fallback=10.0),
+                                      daily_reserve=config.getint('SauceNao', 'daily_reserve', fallback=0))
+
+        # Perceptual hash cache settings
+        self._phash_enabled = config.getboolean('Cache', 'perceptual_hash', fallback=True)
+        self._phash_distance = min(config.getint('Cache', 'perceptual_hash_distance', fallback=2), 3)
+        self._phash_max_size = config.getint('Cache', 'perceptual_hash_max_size', fallback=8388608)
+        self._phash_min_bits = config.getint('Cache', 'perceptual_hash_min_bits', fallback=8)
+        # Images are downloaded from URL's members give us, so internal addresses must be off limits
+        self._allow_private_downloads = config.getboolean('Imaging', 'allow_private_downloads', fallback=False)
+        self._session = transport.session(public_only=not self._allow_private_downloads,
+                                          timeout=aiohttp.ClientTimeout(total=15))
+
+        # Images are downloaded once, then hashed and downscaled before being uploaded to SauceNao and trace.moe
+        self._max_image_size = config.getint('Imaging', 'max_download_size', fallback=8388608)
+        self._upload_max_edge = config.getint('Imaging', 'upload_max_edge', fallback=0)
+        self._upload_quality = config.getint('Imaging', 'upload_quality', fallback=85)
+        self._thumbnails = LRUCache('thumbnails', 64, 300.0)
+
+        # Members may only perform member_api_limit lookups every 5 minutes
+        self._member_limit = config.getint('SauceNao', 'member_api_limit', fallback=0)
+        # When running as a cluster, limits may be tracked in the database so every worker enforces the same limit
+        self._shared_limits = config.get('Cluster', 'rate_limit_backend', fallback='memory') == 'database'
+        if self._shared_limits:
+            self._member_limiter = DatabaseLimiter('member', self._member_limit, 300)
+        else:
+            self._member_limiter = SlidingWindowLimiter(self._member_limit, 300)
+
+        # Concurrent lookups of the same image share a single query
+        self._url_lookups = SingleFlight('url_lookups')
+        self._hash_lookups = SingleFlight('hash_lookups')
+        self._preview_lookups = SingleFlight('preview_lookups')
+
+        # Recently posted images in each channel, for bare ?sauce commands
+        self._recent_images = RecentImageIndex(
+            config.getint('Cache', 'recent_image_channels', fallback=10000),
+            idle_timeout=config.getfloat('Cache', 'recent_image_ttl', fallback=3600.0)
+        )
+
+        # Recently used results are held in memory so hot images never touch the database
+        self._result_cache = LRUCache('results', config.getint('Cache', 'memory_size', fallback=1024),
+                                      config.getfloat('Cache', 'memory_ttl', fallback=3600.0))
+
+        scheduler.add_job('sweep_memory', 600, self.sweep_memory)
         self.ready_tracemoe()
 
     def ready_tracemoe(self):
         token = config.get('TraceMoe', 'token', fallback=None)
         if token:
-            self.tracemoe = ATraceMoe(bot.loop, token)
+            self.tracemoe = ATraceMoe(
+                bot.loop, token,
+                max_download_size=config.getint('TraceMoe', 'max_download_size', fallback=8388608),
+                spool_threshold=config.getint('TraceMoe', 'spool_threshold', fallback=1048576),
+                max_edge=self._upload_max_edge, quality=self._upload_quality,
+                session=transport.session(raise_for_status=True)
+            )
+
+    async def cog_before_invoke(self, ctx: commands.Context) -> None:
+        ctx.started_at = perf_counter()
+        metrics.gauge('saucebot_commands_in_flight', 'Commands currently being processed',
+                      command=ctx.command.name).inc()
+
+    async def cog_after_invoke(self, ctx: commands.Context) -> None:
+        metrics.gauge('saucebot_commands_in_flight', 'Commands currently being processed',
+                      command=ctx.command.name).dec()
+        metrics.histogram('saucebot_command_seconds', 'Command latency, from invocation to completion',
+                          buckets=(.1, .25, .5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0, 60.0),
+                          command=ctx.command.name).observe(perf_counter() - ctx.started_at)
 
     @commands.command(aliases=['source'])
-    @commands.cooldown(server_api_limit or 10000, 86400, commands.BucketType.guild)
     async def sauce(self, ctx: commands.Context, url: typing.Optional[str] = None) -> None:
         """
         Get the source of the attached image, the image in the message you replied to, the specified image URL,
@@ -106,7 +194,7 @@ class Sauce(commands.Cog):
             return
 
         # Make sure this user hasn't exceeded their API limits
-        if self._check_member_limited(ctx):
+        if await self._check_member_limited(ctx):
             await ctx.reply(
                 embed=basic_embed(
                     title=lang('Global', 'generic_error'),
@@ -116,6 +204,18 @@ class Sauce(commands.Cog):
             )
             return
 
+        # Make sure this guild hasn't exceeded its daily API limits
+        if not await self._check_guild_quota(ctx):
+            self._log.info(f"[{ctx.guild.name}] Guild has exceeded their available API queries for the day")
+            await ctx.reply(
+                embed=basic_embed(
+                    title=lang('Global', 'generic_error'),
+                    description=lang('Sauce', 'api_limit_exceeded'),
+                    avatar=saucebot.assets.AVATAR_THINKING
+                )
+            )
+            return
+
         # Attempt to find the source of this image
         try:
             preview = None
@@ -164,18 +264,6 @@ class Sauce(commands.Cog):
             )
             return
 
-        # If it's an anime, see if we can find a preview clip
-        if isinstance(sauce, AnimeSource):
-            preview_file, nsfw = await self._video_preview(sauce, url, True)
-            if preview_file:
-                if nsfw and not ctx.channel.is_nsfw():
-                    self._log.info(f"Channel #{ctx.channel.name} is not NSFW; not uploading an NSFW video here")
-                else:
-                    preview = discord.File(
-                            BytesIO(preview_file),
-                            filename=f"{sauce.title}_preview.mp4".lower().replace(' ', '_')
-                    )
-
         # We didn't find anything, provide some suggestions for manual investigation
         if not sauce:
             self._log.info(f"[{ctx.guild.name}] No image sources found")
@@ -200,7 +288,32 @@ class Sauce(commands.Cog):
             await ctx.reply(embed=embed)
             return
 
-        await ctx.reply(embed=await self._build_sauce_embed(ctx, sauce), file=preview)
+        # If it's an anime, see if we can find a preview clip
+        preview_file = None  # type: typing.Optional[SharedFile]
+        if isinstance(sauce, AnimeSource):
+            preview_file, nsfw = await self._preview_lookups.do(url, self._video_preview, sauce, url, True)
+            if preview_file:
+                # Concurrent lookups of the same image share the preview, so it's closed once all of them are done
+                preview_file.acquire()
+                if nsfw and not ctx.channel.is_nsfw():
+                    self._log.info(f"Channel #{ctx.channel.name} is not NSFW; not uploading an NSFW video here")
+                elif preview_file.size > ctx.guild.filesize_limit:
+                    self._log.info(f"[{ctx.guild.name}] Video preview exceeds the guilds upload limit")
+                else:
+                    preview = discord.File(
+                            preview_file.reader(),
+                            filename=f"{sauce.title}_preview.mp4".lower().replace(' ', '_')
+                    )
+
+        try:
+            with _stage('embed_build'):
+                embed = await self._build_sauce_embed(ctx, sauce)
+
+            with _stage('discord_reply'):
+                await ctx.reply(embed=embed, file=preview)
+        finally:
+            if preview_file:
+                preview_file.release()
 
         # Only delete the command message if it doesn't contain the image we just looked up
         if not image_in_command and not ctx.message.reference:
@@ -215,24 +328,61 @@ class Sauce(commands.Cog):
         Returns:
             typing.Optional[str]
         """
-        async for message in ctx.channel.history(limit=50):  # type: discord.Message
-            # Do we have any image or video attachments?
-            image_attachments = self._get_image_attachments(message)
+        # Images posted since we started are indexed as they come in; otherwise we have to search the channel history
+        # Commands are invoked before on_message listeners run, so images in the command itself aren't indexed yet
+        with _stage('resolve_image'):
+            image_urls = self._get_message_images(ctx.message) or self._recent_images.latest(ctx.channel.id)
+            if image_urls is None:
+                self._log.debug(f"[{ctx.guild.name}] No indexed images for #{ctx.channel.name}; searching history")
+                async for message in ctx.channel.history(limit=50):  # type: discord.Message
+                    image_urls = self._get_message_images(message)
+                    if image_urls:
+                        break
+
+        if not image_urls:
+            return None
 
-            if image_attachments:
-                if len(image_attachments) > 1:
-                    attachment = await self._index_prompt(ctx, ctx.channel, image_attachments)
-                else:
-                    attachment = image_attachments[0]
+        image_url = await self._index_prompt(ctx, ctx.channel, image_urls) if len(image_urls) > 1 else image_urls[0]
+        self._log.info(f"[{ctx.guild.name}] Image found: {image_url}")
+        return image_url
+
+    def _get_message_images(self, message: discord.Message) -> typing.List[str]:
+        """
+        Gets the URLs of every image attached to (or linked in) a message
+        Args:
+            message (discord.Message): The message to check.
+
+        Returns:
+            typing.List[str]
+        """
+        # Do we have any image or video attachments?
+        image_attachments = self._get_image_attachments(message)
+        if image_attachments:
+            return [self._get_attachment_image(a) for a in image_attachments]
+
+        # How about a valid image link?
+        if self.IMAGE_URL_RE.match(message.content):
+            self._log.debug(f"Message {message.id} contains an embedded image link: {message.content}")
+            return [message.content]
+
+        return []
+
+    @commands.Cog.listener('on_message')
+    async def index_images(self, message: discord.Message) -> None:
+        """
+        Remember recently posted images so bare ?sauce commands don't have to search the channel history
+        """
+        image_urls = self._get_message_images(message)
+        if image_urls:
+            self._recent_images.add(message.channel.id, message.id, image_urls)
 
-                image_url = self._get_attachment_image(attachment)
-                self._log.info(f"[{ctx.guild.name}] Attachment found: {image_url}")
-                return image_url
+    @commands.Cog.listener('on_raw_message_delete')
+    async def unindex_deleted_image(self, payload: discord.RawMessageDeleteEvent) -> None:
+        self._recent_images.remove(payload.channel_id, [payload.message_id])
 
-            # How about a valid image link?
-            if self.IMAGE_URL_RE.match(message.content):
-                self._log.debug(f"[{ctx.guild.name}] Message contains an embedded image link: {message.content}")
-                return message.content
+    @commands.Cog.listener('on_raw_bulk_message_delete')
+    async def unindex_deleted_images(self, payload: discord.RawBulkMessageDeleteEvent) -> None:
+        self._recent_images.remove(payload.channel_id, payload.message_ids)
 
     def _get_image_attachments(self, message: discord.Message) -> typing.Optional[typing.List[discord.Attachment]]:
         """
@@ -300,42 +450,257 @@ class Sauce(commands.Cog):
             typing.Optional[GenericSource]
         """
         # Get the API key for this server
-        api_key = Servers.lookup_guild(ctx.guild)
+        api_key = guild_metadata.api_key(ctx.guild.id)
         if not api_key:
             api_key = self._api_key
 
         # Log the query
-        SauceQueries.log(ctx, url)
+        query_log.log(ctx, url)
+        stats.increment('query_count')
 
-        cache = SauceCache.fetch(url)  # type: SauceCache
+        sauce = self._result_cache.get(url)  # type: typing.Optional[GenericSource]
+        if sauce:
+            self._log.info(f'Memory cache entry found: {sauce.title}')
+            return sauce
+
+        # If someone else is already looking this image up with the same API key, wait for their results instead
+        # Guilds with their own API key never have their lookups charged to (or rate limited by) another key
+        return await self._url_lookups.do((url, api_key), self._lookup_sauce, ctx.guild, url, api_key)
+
+    async def _lookup_sauce(self, guild: discord.Guild, url: str, api_key: typing.Optional[str]) \
+            -> typing.Optional[GenericSource]:
+        """
+        Look up the supplied URL in the query cache, falling back to the perceptual cache and then SauceNao
+        Args:
+            guild (discord.Guild):
+            url (str):
+            api_key (typing.Optional[str]):
+
+        Returns:
+            typing.Optional[GenericSource]
+        """
+        with _stage('cache_lookup'):
+            cache = await SauceCache.fetch(url)  # type: SauceCache
         if cache:
-            container   = getattr(pysaucenao.containers, cache.result_class)
-            sauce       = container(cache.header, cache.result)  # type: GenericSource
+            sauce = self._load_cache_entry(cache)
             self._log.info(f'Cache entry found: {sauce.title}')
+            self._result_cache.set(url, sauce)
+            return sauce
+
+        # The image is only downloaded if we are going to hash or upload it
+        image = None
+        if self._phash_enabled or self._upload_max_edge:
+            with _stage('image_download'):
+                image = await self._download_image(url)
+
+        # The same image may have been looked up before (or is being looked up right now) under a different URL
+        image_hash = await self._get_image_hash(url, image) if self._phash_enabled and image else None
+        if image_hash is not None:
+            sauce = await self._hash_lookups.do((image_hash, api_key), self._lookup_image_hash, guild, url, api_key,
+                                                image_hash, image)
         else:
-            # Initialize SauceNao and execute a search query
-            saucenao = SauceNao(api_key=api_key,
-                                min_similarity=float(config.get('SauceNao', 'min_similarity', fallback=50.0)),
-                                priority=[21, 22, 5, 37, 25])
-            search = await saucenao.from_url(url)
-            sauce = search.results[0] if search.results else None
-
-            # Log output
-            rep = reprlib.Repr()
-            rep.maxstring = 16
-            self._log.debug(
-                f"[{ctx.guild.name}] {search.short_remaining} short API queries remaining for {rep.repr(api_key)}"
-            )
-            self._log.info(
-                f"[{ctx.guild.name}] {search.long_remaining} daily API queries remaining for {rep.repr(api_key)}"
-            )
+            sauce = await self._query_sauce(guild, url, api_key, image)
+
+        # Cache the search result
+        if sauce:
+            self._result_cache.set(url, sauce)
+            await SauceCache.add_or_update(url, sauce)
+
+        return sauce
+
+    async def _lookup_image_hash(self, guild: discord.Guild, url: str, api_key: typing.Optional[str],
+                                 image_hash: int, image: typing.Optional[bytes] = None) \
+            -> typing.Optional[GenericSource]:
+        """
+        Look up an image in the perceptual cache, falling back to SauceNao
+        Args:
+            guild (discord.Guild):
+            url (str):
+            api_key (typing.Optional[str]):
+            image_hash (int): Perceptual hash of the image
+            image (typing.Optional[bytes]): The downloaded image
+
+        Returns:
+            typing.Optional[GenericSource]
+        """
+        with _stage('cache_lookup'):
+            cache = await SauceHashCache.fetch(image_hash, self._phash_distance)
+        if cache:
+            sauce = self._load_cache_entry(cache)
+            self._log.info(f'Perceptual cache entry found: {sauce.title}')
+            return sauce
+
+        sauce = await self._query_sauce(guild, url, api_key, image)
+        if sauce:
+            await SauceHashCache.add_or_update(image_hash, sauce)
+
+        return sauce
 
-            # Cache the search result
-            if sauce:
-                SauceCache.add_or_update(url, sauce)
+    async def _query_sauce(self, guild: discord.Guild, url: str, api_key: typing.Optional[str],
+                           image: typing.Optional[bytes] = None) -> typing.Optional[GenericSource]:
+        """
+        Execute a SauceNao search query
+        When we have already downloaded the image, a downscaled copy is uploaded instead of having SauceNao fetch the
+        full size image itself.
+        Args:
+            guild (discord.Guild):
+            url (str):
+            api_key (typing.Optional[str]):
+            image (typing.Optional[bytes]): The downloaded image
+
+        Returns:
+            typing.Optional[GenericSource]
+        """
+        thumbnail = await self._get_thumbnail(url, image) if image else None
+        with _stage('saucenao'):
+            if thumbnail:
+                search = await self._saucenao.get(api_key).from_file(io.BytesIO(thumbnail), guild.id)
+            else:
+                search = await self._saucenao.get(api_key).from_url(url, guild.id)
+        sauce = search.results[0] if search.results else None
+
+        # Log output
+        rep = reprlib.Repr()
+        rep.maxstring = 16
+        self._log.debug(
+            f"[{guild.name}] {search.short_remaining} short API queries remaining for {rep.repr(api_key)}"
+        )
+        self._log.info(
+            f"[{guild.name}] {search.long_remaining} daily API queries remaining for {rep.repr(api_key)}"
+        )
 
         return sauce
 
+    def _load_cache_entry(self, cache: typing.Union[SauceCache, SauceHashCache]) -> GenericSource:
+        """
+        Rebuilds a SauceNao result container from a cache entry
+        Args:
+            cache (typing.Union[SauceCache, SauceHashCache]):
+
+        Returns:
+            GenericSource
+        """
+        container = getattr(pysaucenao.containers, cache.result_class)
+        return container(cache.header, cache.result)
+
+    async def _download_image(self, url: str) -> typing.Optional[bytes]:
+        """
+        Downloads an image so it can be hashed and downscaled
+        Only public addresses are downloaded from, as the URL may have been supplied by a member. When the image can't
+        be downloaded, the URL is sent to SauceNao instead.
+        Args:
+            url (str):
+
+        Returns:
+            typing.Optional[bytes]: The image, or None if it could not be downloaded or is too large
+        """
+        # noinspection PyBroadException
+        try:
+            target = yarl.URL(url)
+            # Redirects are followed by hand, so every hop is checked before we connect to it
+            for _ in range(self.MAX_REDIRECTS + 1):
+                if not self._is_downloadable(target):
+                    self._log.info(f"Refusing to download image from a non-public address: {target}")
+                    return None
+
+                async with self._session.get(target, allow_redirects=False) as response:
+                    if response.status in (301, 302, 303, 307, 308) and 'Location' in response.headers:
+                        target = response.url.join(yarl.URL(response.headers['Location']))
+                        continue
+
+                    if response.status != 200:
+                        self._log.info(f"Unable to download image (HTTP {response.status}): {url}")
+                        return None
+
+                    data = bytearray()
+                    async for chunk in response.content.iter_chunked(65536):
+                        data += chunk
+                        if len(data) > self._max_image_size:
+                            self._log.info(f"Image is too large to download: {url}")
+                            return None
+
+                return bytes(data)
+
+            self._log.info(f"Too many redirects downloading image: {url}")
+            return None
+        except Exception:
+            self._log.info(f"Unable to download image: {url}", exc_info=True)
+            return None
+
+    def _is_downloadable(self, url: yarl.URL) -> bool:
+        """
+        Checks that a URL is safe for us to download from
+        Hostnames are resolved to public addresses only by the session; IP addresses have to be checked here.
+        Args:
+            url (yarl.URL):
+
+        Returns:
+            bool
+        """
+        if url.scheme not in ('http', 'https') or not url.host:
+            return False
+
+        if self._allow_private_downloads:
+            return True
+
+        try:
+            ipaddress.ip_address(url.host.split('%', 1)[0])
+        except ValueError:
+            return True
+
+        return is_public_address(url.host)
+
+    async def _get_image_hash(self, url: str, image: bytes) -> typing.Optional[int]:
+        """
+        Computes the perceptual hash of a downloaded image
+        Args:
+            url (str):
+            image (bytes): The downloaded image
+
+        Returns:
+            typing.Optional[int]: The hash, or None if the image could not be processed or has too little detail
+        """
+        if len(image) > self._phash_max_size:
+            self._log.info(f"Image is too large to hash: {url}")
+            return None
+
+        try:
+            image_hash = await image_pool.dhash(image)
+        except ImageProcessingError as e:
+            self._log.info(f"Unable to compute a perceptual hash for {url}: {e}")
+            return None
+
+        # Low detail images would all match each other
+        if not is_distinctive(image_hash, self._phash_min_bits):
+            self._log.info(f"Image has too little detail to be looked up by its perceptual hash: {url}")
+            return None
+
+        return image_hash
+
+    async def _get_thumbnail(self, url: str, image: bytes) -> typing.Optional[bytes]:
+        """
+        Downscales a downloaded image for uploading
+        The result is briefly cached, so the trace.moe search that may follow can reuse it.
+        Args:
+            url (str):
+            image (bytes): The downloaded image
+
+        Returns:
+            typing.Optional[bytes]: The downscaled image, or None if downscaling is disabled or failed
+        """
+        if not self._upload_max_edge:
+            return None
+
+        try:
+            thumbnail = await image_pool.downscale(image, self._upload_max_edge, self._upload_quality)
+        except ImageProcessingError as e:
+            self._log.info(f"Unable to downscale {url}; falling back to the original image: {e}")
+            return None
+
+        self._log.debug(f"Downscaled {url} from {len(image)} to {len(thumbnail)} bytes")
+        self._thumbnails.set(url, thumbnail)
+        return thumbnail
+
     async def _build_sauce_embed(self, ctx: commands.Context, sauce: GenericSource) -> discord.Embed:
         """
         Builds a Discord embed for the provided SauceNao lookup
@@ -393,7 +758,7 @@ class Sauce(commands.Cog):
         return embed
 
     async def _video_preview(self, sauce: AnimeSource, path_or_fh: typing.Union[str, typing.BinaryIO],
-                             is_url: bool) -> typing.Tuple[typing.Optional[bytes], bool]:
+                             is_url: bool) -> typing.Tuple[typing.Optional[SharedFile], bool]:
         """
         Attempt to grab a video preview of an AnimeSource entry from trace.moe
         Args:
@@ -402,14 +767,21 @@ class Sauce(commands.Cog):
             is_url (bool): Path is a URL to an image rather than a file path.
 
         Returns:
-            typing.Tuple[typing.Optional[bytes], bool]: The video preview if available, and whether the video is NSFW.
+            typing.Tuple[typing.Optional[SharedFile], bool]: The video preview if available, and whether the video is
+                NSFW. The preview may be shared between concurrent lookups, so each upload should use its own reader.
         """
         if not self.tracemoe:
             return None, False
 
+        # Reuse the downscaled image we uploaded to SauceNao, if we still have it
+        thumbnail = self._thumbnails.get(path_or_fh) if is_url else None
+        if thumbnail:
+            path_or_fh, is_url = io.BytesIO(thumbnail), False
+
         # noinspection PyBroadException
         try:
-            tracemoe_sauce = await self.tracemoe.search(path_or_fh, is_url=is_url)
+            with _stage('tracemoe_search'):
+                tracemoe_sauce = await self.tracemoe.search(path_or_fh, is_url=is_url)
             if not tracemoe_sauce.get('docs'):
                 self._log.info("Tracemoe returned no results")
                 return None, False
@@ -425,54 +797,60 @@ class Sauce(commands.Cog):
                 return None, False
 
             self._log.info(f'Downloading video preview for AniList entry {sauce.anilist_id} from trace.moe')
-            tracemoe_preview = await self.tracemoe.video_preview_natural(tracemoe_sauce)
-            return tracemoe_preview, tracemoe_sauce['docs'][0]['is_adult']
+            # noinspection PyBroadException
+            try:
+                with _stage('preview_download'):
+                    tracemoe_preview = await self.tracemoe.video_preview_natural(tracemoe_sauce)
+            except Exception as e:
+                self._log.error(f"Unable to download the video preview from trace.moe: {e}")
+                return None, False
+
+            return SharedFile(tracemoe_preview), tracemoe_sauce['docs'][0]['is_adult']
 
         return None, False
 
-    @sauce.error
-    async def sauce_error(self, ctx: commands.Context, error) -> None:
+    async def _check_member_limited(self, ctx: commands.Context) -> bool:
         """
-        Override guild cooldowns for servers with their own API keys provided
+        Check if the author of this message has exceeded their API limits, counting this query towards them if not
+        The check and the count are one step, so concurrent commands from the same member can't all pass the check.
         Args:
             ctx (commands.Context):
-            error (Exception):
 
         Returns:
-            None
+            bool
         """
-        if isinstance(error, commands.CommandOnCooldown):
-            if Servers.lookup_guild(ctx.guild):
-                self._log.info(f"[{ctx.guild.name}] Guild has an enhanced API key; ignoring triggered guild API limit")
-                await ctx.reinvoke()
-                return
+        if not self._member_limit:
+            self._log.debug('No member limit defined')
+            return False
 
-            self._log.info(f"[{ctx.guild.name}] Guild has exceeded their available API queries for the day")
-            await ctx.send(
-                embed=basic_embed(
-                    title=lang('Global', 'generic_error'),
-                    description=lang('Sauce', 'api_limit_exceeded')
-                )
-            )
+        if self._shared_limits:
+            return not await self._member_limiter.acquire(ctx.author.id)
 
-        raise error
+        # Load recent queries from the database the first time we see a member, so limits survive restarts
+        if ctx.author.id not in self._member_limiter:
+            history = await SauceQueries.user_history(ctx.author, 5, self._member_limit)
+            self._member_limiter.seed(ctx.author.id, history)
 
-    def _check_member_limited(self, ctx: commands.Context) -> bool:
+        return not self._member_limiter.acquire(ctx.author.id)
+
+    async def _check_guild_quota(self, ctx: commands.Context) -> bool:
         """
-        Check if the author of this message has exceeded their API limits
+        Consume a query from this guilds daily API quota
+        Guilds that have registered their own API key are exempt.
         Args:
             ctx (commands.Context):
 
         Returns:
-            bool
+            bool: Returns False if the guild has exceeded its quota
         """
-        member_limit = config.getint('SauceNao', 'member_api_limit', fallback=0)
-        if not member_limit:
-            self._log.debug('No member limit defined')
-            return False
+        if not server_api_limit:
+            return True
+
+        if guild_metadata.api_key(ctx.guild.id):
+            self._log.debug(f"[{ctx.guild.name}] Guild has an enhanced API key; ignoring the guild API limit")
+            return True
 
-        count = SauceQueries.user_count(ctx.author)
-        return count >= member_limit
+        return await GuildQuotas.consume(ctx.guild, server_api_limit)
 
     @commands.command()
     @commands.has_permissions(administrator=True)
@@ -500,8 +878,7 @@ class Sauce(commands.Cog):
             return
 
         # Test and make sure it's a valid enhanced-level API key
-        saucenao = SauceNao(api_key=api_key)
-        test = await saucenao.test()
+        test = await self._saucenao.get(api_key).test()
 
         # Make sure the test went through successfully
         if not test.success:
@@ -528,7 +905,7 @@ class Sauce(commands.Cog):
             )
             return
 
-        Servers.register(ctx.guild, api_key)
+        await Servers.register(ctx.guild, api_key)
         await ctx.send(
             embed=basic_embed(
                 title=lang('Global', 'generic_success'),
@@ -536,19 +913,15 @@ class Sauce(commands.Cog):
             )
         )
 
-    # noinspection PyBroadException
-    async def purge_cache(self):
+    async def sweep_memory(self) -> None:
         """
-        Task to purge SauceNao cache entries older than 24-hours every 6-hours
+        Maintenance task releasing idle in-memory state and reporting cache statistics
         Returns:
             None
         """
-        await bot.wait_until_ready()
-
-        while not bot.is_closed():
-            try:
-                self._log.info('[SYSTEM] Purging SauceNao query cache')
-                SauceCache.purge_cache()
-                await asyncio.sleep(21600)
-            except Exception:
-                self._log.exception('An unknown error occurred while purging the local query cache')
+        self._log.info(f'[SYSTEM] Memory cache: {len(self._result_cache)} entries, '
+                       f'{self._result_cache.hit_rate:.1%} hit rate, '
+                       f'{self._result_cache.evictions.value} evictions')
+        if not self._shared_limits:
+            self._log.debug(f'[SYSTEM] Released {self._member_limiter.sweep()} idle member rate limits')
+        self._log.debug(f'[SYSTEM] Forgot recent images in {self._recent_images.sweep()} idle channel(s)')
@@ -4,5 +4,5 @@ from configparser import ConfigParser
 config = ConfigParser()
 config.read(['config.default.ini', 'config.ini'])
 
-server_api_limit = config.get('SauceNao', 'server_api_limit', fallback=None)
+server_api_limit = int(config.get('SauceNao', 'server_api_limit', fallback=None) or 0)
 member_api_limit = config.get('SauceNao', 'member_api_limit', fallback=None)
\ No newline at end of file
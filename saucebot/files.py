@@ -0,0 +1,101 @@
+import io
+import os
+import threading
+import typing
+
+from aiohttp import payload
+
+
+class SharedFile:
+    """
+    Wraps a file (generally a spooled download) so it can be read by several consumers at once without copying it
+    Every consumer acquires the file before using it and releases it when done; the file is closed once the last
+    consumer has released it.
+    """
+
+    def __init__(self, file: typing.BinaryIO):
+        self.file = file
+        self.lock = threading.Lock()
+        self._references = 0
+
+        file.seek(0, os.SEEK_END)
+        self.size = file.tell()
+        file.seek(0)
+
+    def reader(self) -> 'SharedFileReader':
+        """
+        Returns a new reader with its own read position
+        """
+        return SharedFileReader(self)
+
+    def acquire(self) -> 'SharedFile':
+        self._references += 1
+        return self
+
+    def release(self) -> None:
+        self._references -= 1
+        if self._references <= 0:
+            self.close()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class SharedFileReader(io.RawIOBase):
+    """
+    An independent, seekable, read-only view of a SharedFile
+    Uploads may read from worker threads, so every read repositions the underlying file under the shared lock.
+    """
+
+    def __init__(self, shared: SharedFile):
+        super().__init__()
+        self._shared = shared
+        self._position = 0
+
+    @property
+    def size(self) -> int:
+        return self._shared.size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        with self._shared.lock:
+            self._shared.file.seek(self._position)
+            data = self._shared.file.read(len(buffer))
+
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            self._position = offset
+        elif whence == os.SEEK_CUR:
+            self._position += offset
+        elif whence == os.SEEK_END:
+            self._position = self._shared.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+
+        self._position = max(self._position, 0)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+class SharedFilePayload(payload.IOBasePayload):
+    """
+    Uploads a SharedFileReader with a known length, so multipart requests aren't sent chunked
+    """
+
+    @property
+    def size(self) -> int:
+        return max(self._value.size - self._value.tell(), 0)
+
+
+payload.register_payload(SharedFilePayload, SharedFileReader, order=payload.Order.try_first)
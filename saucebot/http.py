@@ -0,0 +1,148 @@
+import ipaddress
+import logging
+import socket
+import typing
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+
+from saucebot.bot import bot
+from saucebot.config import config
+
+
+def is_public_address(address: str) -> bool:
+    """
+    Checks whether an IP address is publicly routable
+    Private, loopback, link-local (including cloud metadata services), shared and reserved addresses are not.
+    Args:
+        address (str): An IPv4 or IPv6 address
+
+    Returns:
+        bool: False for anything that is not a valid public address
+    """
+    try:
+        ip = ipaddress.ip_address(address.split('%', 1)[0])
+    except ValueError:
+        return False
+
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+
+    return ip.is_global and not ip.is_multicast
+
+
+class PublicResolver(AbstractResolver):
+    """
+    Resolves hostnames to public addresses only, so requests to user supplied URL's can never reach internal services
+    Filtering the resolved addresses (rather than checking the hostname up front) also covers DNS rebinding.
+    """
+
+    def __init__(self, resolver: typing.Optional[AbstractResolver] = None):
+        self._resolver = resolver or aiohttp.DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> typing.List[dict]:
+        addresses = [a for a in await self._resolver.resolve(host, port, family) if is_public_address(a['host'])]
+        if not addresses:
+            raise OSError(f"{host} does not resolve to a public address")
+
+        return addresses
+
+    async def close(self) -> None:
+        await self._resolver.close()
+
+
+class HttpTransport:
+    """
+    A single pooled HTTP transport shared by every SauceBot subsystem that talks to the web
+    All sessions are bound to one connector, so connection limits, DNS caching and keep-alive apply bot-wide.
+    """
+
+    def __init__(self, loop, limit: int = 100, limit_per_host: int = 20, dns_cache_ttl: int = 300,
+                 keepalive_timeout: float = 30.0):
+        """
+        Args:
+            loop: The event loop
+            limit (int): Maximum number of simultaneous connections
+            limit_per_host (int): Maximum number of simultaneous connections to a single host
+            dns_cache_ttl (int): Seconds resolved hostnames are cached for
+            keepalive_timeout (float): Seconds idle connections are kept open for reuse
+        """
+        self._loop = loop
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._dns_cache_ttl = dns_cache_ttl
+        self._keepalive_timeout = keepalive_timeout
+        self._connector = None  # type: typing.Optional[aiohttp.TCPConnector]
+        self._public_connector = None  # type: typing.Optional[aiohttp.TCPConnector]
+        self._sessions = []  # type: typing.List[aiohttp.ClientSession]
+        self._log = logging.getLogger(__name__)
+
+    @property
+    def connector(self) -> aiohttp.TCPConnector:
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(
+                loop=self._loop,
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                use_dns_cache=True,
+                ttl_dns_cache=self._dns_cache_ttl,
+                keepalive_timeout=self._keepalive_timeout
+            )
+
+        return self._connector
+
+    @property
+    def public_connector(self) -> aiohttp.TCPConnector:
+        """
+        A separate connector that only connects to hostnames resolving to public addresses
+        """
+        if self._public_connector is None or self._public_connector.closed:
+            self._public_connector = aiohttp.TCPConnector(
+                loop=self._loop,
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                use_dns_cache=True,
+                ttl_dns_cache=self._dns_cache_ttl,
+                keepalive_timeout=self._keepalive_timeout,
+                resolver=PublicResolver()
+            )
+
+        return self._public_connector
+
+    def session(self, public_only: bool = False, **kwargs) -> aiohttp.ClientSession:
+        """
+        Create a client session that uses the shared connector
+        Args:
+            public_only (bool): Only connect to public addresses; use this for URL's supplied by members. IP address
+                literals are not resolved, so they must still be checked with is_public_address.
+            **kwargs: Session options, e.g. default headers, timeouts or raise_for_status
+
+        Returns:
+            aiohttp.ClientSession
+        """
+        connector = self.public_connector if public_only else self.connector
+        session = aiohttp.ClientSession(loop=self._loop, connector=connector, connector_owner=False, **kwargs)
+        self._sessions.append(session)
+        return session
+
+    async def close(self) -> None:
+        """
+        Close every session created by this transport, followed by the shared connector
+        """
+        self._log.info(f"Closing {len(self._sessions)} HTTP session(s)")
+        for session in self._sessions:
+            await session.close()
+        self._sessions.clear()
+
+        for connector in (self._connector, self._public_connector):
+            if connector is not None:
+                await connector.close()
+
+
+transport = HttpTransport(
+    bot.loop,
+    limit=config.getint('HTTP', 'connection_limit', fallback=100),
+    limit_per_host=config.getint('HTTP', 'connection_limit_per_host', fallback=20),
+    dns_cache_ttl=config.getint('HTTP', 'dns_cache_ttl', fallback=300),
+    keepalive_timeout=config.getfloat('HTTP', 'keepalive_timeout', fallback=30.0)
+)
@@ -0,0 +1,264 @@
+import asyncio
+import io
+import multiprocessing
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from time import perf_counter
+
+from PIL import Image
+
+from saucebot import metrics
+from saucebot.config import config
+
+
+class ImageProcessingError(Exception):
+    pass
+
+
+def identify(data: bytes) -> typing.Tuple[str, bool]:
+    """
+    Identifies an image from its headers without decoding it
+    Args:
+        data (bytes): The raw image data
+
+    Raises:
+        ImageProcessingError: The data is not an image we can read
+
+    Returns:
+        typing.Tuple[str, bool]: The image format, and whether or not it is animated
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return image.format, getattr(image, 'is_animated', False)
+    except (IOError, SyntaxError) as e:
+        raise ImageProcessingError(f"Invalid image: {e}")
+
+
+def first_frame(data: bytes, quality: int = 90) -> bytes:
+    """
+    Extracts the first frame of an (animated) image as a JPEG
+    Args:
+        data (bytes): The raw image data
+        quality (int): JPEG quality
+
+    Returns:
+        bytes
+    """
+    output = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as image:
+        image.seek(0)
+        image.convert('RGB').save(output, format='JPEG', quality=quality)
+
+    return output.getvalue()
+
+
+def downscale(data: bytes, max_edge: int, quality: int = 85) -> bytes:
+    """
+    Shrinks the first frame of an image to fit within a square of max_edge pixels and re-encodes it as a JPEG
+    Args:
+        data (bytes): The raw image data
+        max_edge (int): Maximum width and height of the result
+        quality (int): JPEG quality
+
+    Returns:
+        bytes: The downscaled image, or the original data if it is already a small enough JPEG
+    """
+    output = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as image:
+        if image.format == 'JPEG' and max(image.size) <= max_edge:
+            return data
+
+        # Let the JPEG decoder downscale for us when possible, which is much faster than decoding the full image
+        image.draft('RGB', (max_edge, max_edge))
+        image = image.convert('RGB')
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+
+    return output.getvalue()
+
+
+def dhash(data: bytes, size: int = 8) -> int:
+    """
+    Computes a perceptual difference hash (dHash) of an image
+    Visually identical images produce the same or a very similar hash, even after being re-encoded or resized.
+    Args:
+        data (bytes): The raw image data
+        size (int): The hash width; the resulting hash is size * size bits long
+
+    Returns:
+        int
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        # Let the JPEG decoder downscale for us when possible, which is much faster than decoding the full image
+        image.draft('L', (size * 8, size * 8))
+        image = image.convert('L').resize((size + 1, size), Image.LANCZOS)
+
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+
+    return value
+
+
+def hash_segments(image_hash: int, segments: int = 4, bits: int = 64) -> typing.List[int]:
+    """
+    Splits a hash into equally sized segments
+    If two hashes differ by fewer than `segments` bits, at least one of their segments must match exactly, which lets
+    us find near-duplicates with plain indexed equality lookups.
+    Args:
+        image_hash (int): The hash to split
+        segments (int): The number of segments to split the hash into
+        bits (int): The size of the hash in bits
+
+    Returns:
+        typing.List[int]
+    """
+    width = bits // segments
+    mask = (1 << width) - 1
+    return [(image_hash >> (width * i)) & mask for i in reversed(range(segments))]
+
+
+def is_distinctive(image_hash: int, min_bits: int = 8, bits: int = 64) -> bool:
+    """
+    Checks whether a hash carries enough detail to identify an image
+    Flat or low detail images (blank images, solid colours, most text screenshots) have almost no brightness gradients,
+    so their hashes are nearly all zeros (or all ones) and unrelated images collide.
+    Args:
+        image_hash (int): The hash to check
+        min_bits (int): Minimum number of both set and unset bits
+        bits (int): The size of the hash in bits
+
+    Returns:
+        bool
+    """
+    set_bits = bin(image_hash).count('1')
+    return min(set_bits, bits - set_bits) >= min_bits
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    """
+    Counts the number of differing bits between two hashes
+    """
+    return bin(hash_a ^ hash_b).count('1')
+
+
+class ImageWorkerPool:
+    """
+    Runs CPU heavy image processing in a pool of worker processes, keeping it off the event loop
+    Operations wait in a bounded queue for a free worker. Operations that cannot be queued, or that don't finish within
+    the timeout, fail with an ImageProcessingError.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 100, timeout: float = 10.0):
+        """
+        Args:
+            workers (int): Number of worker processes
+            max_queue (int): Maximum number of operations waiting for a worker
+            timeout (float): Maximum seconds an operation may take, including time spent queued
+        """
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = None  # type: typing.Optional[ProcessPoolExecutor]
+        self._slots = None  # type: typing.Optional[asyncio.Semaphore]
+        self._queued = 0
+
+        self._queue_depth = metrics.gauge('saucebot_image_queue_depth', 'Image operations waiting for a worker')
+
+    def _start(self) -> None:
+        # Worker processes are spawned rather than forked, as forking a process running threads is unsafe
+        self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+
+    async def run(self, operation: typing.Callable, *args):
+        """
+        Run an image operation in a worker process
+        Args:
+            operation (typing.Callable): A module level function (so it can be pickled)
+            *args: Arguments passed to the operation
+
+        Raises:
+            ImageProcessingError: The operation failed, timed out or could not be queued
+
+        Returns:
+            The result of the operation
+        """
+        if self._executor is None:
+            self._start()
+
+        name = operation.__name__
+        if self._queued >= self.max_queue:
+            metrics.counter('saucebot_image_operation_failures_total', 'Failed image operations',
+                            operation=name, reason='queue_full').inc()
+            raise ImageProcessingError(f"Unable to {name} image; the processing queue is full")
+
+        start = perf_counter()
+        try:
+            return await asyncio.wait_for(self._run(operation, *args), self.timeout)
+        except ImageProcessingError:
+            metrics.counter('saucebot_image_operation_failures_total', 'Failed image operations',
+                            operation=name, reason='invalid').inc()
+            raise
+        except asyncio.TimeoutError:
+            metrics.counter('saucebot_image_operation_failures_total', 'Failed image operations',
+                            operation=name, reason='timeout').inc()
+            raise ImageProcessingError(f"Timed out trying to {name} image")
+        except BrokenProcessPool as e:
+            metrics.counter('saucebot_image_operation_failures_total', 'Failed image operations',
+                            operation=name, reason='crashed').inc()
+            raise ImageProcessingError(f"Image worker crashed while trying to {name} image") from e
+        except Exception as e:
+            metrics.counter('saucebot_image_operation_failures_total', 'Failed image operations',
+                            operation=name, reason='error').inc()
+            raise ImageProcessingError(f"Unable to {name} image: {e}") from e
+        finally:
+            metrics.histogram('saucebot_image_operation_seconds', 'Image operation latency, including time queued',
+                              operation=name).observe(perf_counter() - start)
+
+    async def _run(self, operation: typing.Callable, *args):
+        self._queued += 1
+        self._queue_depth.set(self._queued)
+        try:
+            await self._slots.acquire()
+        finally:
+            self._queued -= 1
+            self._queue_depth.set(self._queued)
+
+        executor = self._executor
+        try:
+            return await asyncio.get_event_loop().run_in_executor(executor, operation, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. it ran out of memory); replace the pool so later operations can still run
+            if self._executor is executor:
+                executor.shutdown(wait=False)
+                self._start()
+            raise
+        finally:
+            self._slots.release()
+
+    async def identify(self, data: bytes) -> typing.Tuple[str, bool]:
+        return await self.run(identify, data)
+
+    async def first_frame(self, data: bytes, quality: int = 90) -> bytes:
+        return await self.run(first_frame, data, quality)
+
+    async def downscale(self, data: bytes, max_edge: int, quality: int = 85) -> bytes:
+        return await self.run(downscale, data, max_edge, quality)
+
+    async def dhash(self, data: bytes, size: int = 8) -> int:
+        return await self.run(dhash, data, size)
+
+    async def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+image_pool = ImageWorkerPool(config.getint('Imaging', 'workers', fallback=2),
+                             config.getint('Imaging', 'max_queue', fallback=100),
+                             config.getfloat('Imaging', 'timeout', fallback=10.0))
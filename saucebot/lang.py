@@ -1,72 +1,192 @@
 import logging
 import os
 import random
+import re
+import types
 import typing
-from configparser import ConfigParser
+from configparser import ConfigParser, InterpolationError
 
 import discord
 
 from saucebot.config import config
 
-# Set up localization for use elsewhere in the application
-_language = config.get('Bot', 'Language', fallback='english')
-_language_config = ConfigParser()
-_language_config.read(os.path.join('lang', f'{_language}.ini'), 'utf-8')
+_log = logging.getLogger(__name__)
 
+# Placeholders look like {name}; any other braces in a language string are literal text
+_PLACEHOLDER_RE = re.compile(r"{([A-Za-z_]\w*)}")
 
-def lang(category: str, key: str, replacements: typing.Optional[dict] = None, default=None,
-         member: typing.Optional[discord.Member] = None):
+MISSING = '<Missing language string>'
+
+
+class _Replacements(dict):
+    """
+    Leaves placeholders we have no replacement for as they are
     """
-    Provides easy to use application localization in the form of ini configuration files
 
-    Language strings can be added or altered in the data/lang folder
+    def __missing__(self, key):
+        return f"{{{key}}}"
+
+
+class Template:
+    """
+    A language string, pre-parsed so it can be rendered in a single pass
     """
-    string = _language_config.get(category, key, fallback=default)  # type: str
-    if string:
-        if replacements:
-            for rkey, rvalue in replacements.items():
-                string = string.replace(f"{{{rkey}}}", str(rvalue))
+    __slots__ = ('text', 'placeholders', '_format')
 
-        if member:
-            string = _member_replacements(string, member)
+    def __init__(self, text: str):
+        self.text = text
+        self.placeholders = frozenset(_PLACEHOLDER_RE.findall(text))
 
-    else:
-        logging.getLogger(__name__).warning(f"Missing {_language} language string: {key} ({category})")
-        return '<Missing language string>'
+        # Compiled to a str.format string: literal braces are escaped, and only our placeholders remain as fields
+        parts = _PLACEHOLDER_RE.split(text)
+        for i in range(0, len(parts), 2):
+            parts[i] = parts[i].replace('{', '{{').replace('}', '}}')
+        for i in range(1, len(parts), 2):
+            parts[i] = f"{{{parts[i]}}}"
+        self._format = ''.join(parts)
 
-    return string
+    def render(self, replacements: typing.Optional[typing.Mapping[str, typing.Any]] = None) -> str:
+        """
+        Fill in the placeholders of this template
+        Every placeholder is replaced at once, so replacement values are never themselves searched for placeholders.
+        Args:
+            replacements (typing.Optional[typing.Mapping[str, typing.Any]]): Placeholder values
 
+        Returns:
+            str
+        """
+        if not self.placeholders or not replacements:
+            return self.text
 
-def rand_lang(category: str, replacements: typing.Optional[dict] = None, default=None,
-              member: typing.Optional[discord.Member] = None):
+        return self._format.format_map(_Replacements(replacements))
+
+
+class LanguageCatalog:
     """
-    An alternative to the regular lang() method that pulls a random language string from the specified category
+    Every string of a language file, compiled once when it is loaded
+    Categories are read-only mappings of keys to templates. Each category's templates are also kept as a tuple, ready
+    for rand_lang to choose from.
     """
-    strings = _language_config.items(category)
-    if strings:
-        key, string = random.choice(strings)
-    else:
-        if default:
-            key, string = None, default
-        else:
-            logging.getLogger(__name__).warning(f"Missing {_language} language category: {category}")
-            return '<Missing language string>'
 
+    def __init__(self, name: str, path: str):
+        """
+        Args:
+            name (str): Name of the language
+            path (str): Path to the language file
+        """
+        self.name = name
+        parser = ConfigParser()
+        if not parser.read(path, 'utf-8'):
+            _log.warning(f"Unable to read the {name} language file: {path}")
+
+        self._categories = types.MappingProxyType({
+            category: types.MappingProxyType({
+                key: Template(self._interpolate(parser, category, key)) for key in parser.options(category)
+            })
+            for category in parser.sections()
+        })
+        self._choices = types.MappingProxyType({
+            category: tuple(templates.values()) for category, templates in self._categories.items()
+        })
+
+    def _interpolate(self, parser: ConfigParser, category: str, key: str) -> str:
+        """
+        Apply ConfigParser interpolation (such as %% for a literal %) once, up front
+        Strings with a stray % (URL escapes, for example) are used exactly as written instead.
+        """
+        try:
+            return parser.get(category, key)
+        except InterpolationError:
+            _log.warning(f"Invalid interpolation in {self.name} language string {key} ({category}); using it as is")
+            return parser.get(category, key, raw=True)
+
+    def get(self, category: str, key: str) -> typing.Optional[Template]:
+        templates = self._categories.get(category)
+        return templates.get(key) if templates else None
+
+    def choices(self, category: str) -> typing.Tuple[Template, ...]:
+        return self._choices.get(category, ())
+
+
+def load_catalogs(languages: typing.Iterable[str], directory: str = 'lang') \
+        -> typing.Mapping[str, LanguageCatalog]:
+    """
+    Compile the language files of several languages
+    Args:
+        languages (typing.Iterable[str]): Names of the languages to load
+        directory (str): Directory containing the language files
+
+    Returns:
+        typing.Mapping[str, LanguageCatalog]
+    """
+    return types.MappingProxyType({
+        name: LanguageCatalog(name, os.path.join(directory, f'{name}.ini')) for name in dict.fromkeys(languages)
+    })
+
+
+# Set up localization for use elsewhere in the application
+# Additional languages are compiled up front too, so guilds can be answered in their own language
+_language = config.get('Bot', 'Language', fallback='english')
+_languages = [_language] + [n.strip() for n in config.get('Bot', 'languages', fallback='').split(',') if n.strip()]
+catalogs = load_catalogs(_languages)
+
+
+def _catalog(language: typing.Optional[str]) -> LanguageCatalog:
+    if language and language in catalogs:
+        return catalogs[language]
+
+    if language:
+        _log.debug(f"The {language} language is not loaded; using {_language} instead")
+
+    return catalogs[_language]
+
+
+def _replacements(replacements: typing.Optional[dict], member: typing.Optional[discord.Member]) \
+        -> typing.Optional[dict]:
+    """
+    Combine explicit replacements with the standard member replacements; explicit replacements take precedence
+    """
+    if not member:
+        return replacements
+
+    values = {'display_name': member.display_name, 'mention': member.mention}
     if replacements:
-        for rkey, rvalue in replacements.items():
-            string = string.replace(f"{{{rkey}}}", rvalue)
+        values.update(replacements)
 
-    if member:
-        string = _member_replacements(string, member)
+    return values
 
-    return string
 
+def lang(category: str, key: str, replacements: typing.Optional[dict] = None, default=None,
+         member: typing.Optional[discord.Member] = None, language: typing.Optional[str] = None):
+    """
+    Provides easy to use application localization in the form of ini configuration files
 
-def _member_replacements(string: str, member: discord.Member) -> str:
+    Language strings can be added or altered in the data/lang folder
     """
-    Perform some standard replacements for language strings
+    catalog = _catalog(language)
+    template = catalog.get(category, key)
+    if not template or not template.text:
+        if not default:
+            _log.warning(f"Missing {catalog.name} language string: {key} ({category})")
+            return MISSING
+        template = Template(default)
+
+    return template.render(_replacements(replacements, member))
+
+
+def rand_lang(category: str, replacements: typing.Optional[dict] = None, default=None,
+              member: typing.Optional[discord.Member] = None, language: typing.Optional[str] = None):
     """
-    string = string.replace('{display_name}', member.display_name)
-    string = string.replace('{mention}', member.mention)
+    An alternative to the regular lang() method that pulls a random language string from the specified category
+    """
+    catalog = _catalog(language)
+    templates = catalog.choices(category)
+    if templates:
+        template = random.choice(templates)
+    elif default:
+        template = Template(default)
+    else:
+        _log.warning(f"Missing {catalog.name} language category: {category}")
+        return MISSING
 
-    return string
+    return template.render(_replacements(replacements, member))
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import typing
+from time import monotonic, perf_counter, time
+
+from saucebot import metrics
+from saucebot.bot import bot
+from saucebot.config import config
+from saucebot.models.database import GuildQuotas, RateLimitHits, SauceCache, SauceHashCache, SauceQueries, \
+    load_guild_metadata
+
+_log = logging.getLogger(__name__)
+
+
+class MaintenanceJob:
+    """
+    A periodic background job
+    """
+
+    def __init__(self, name: str, interval: float, function: typing.Callable[[], typing.Awaitable]):
+        self.name = name
+        self.interval = interval
+        self.function = function
+        self.next_run = monotonic()
+
+        self.duration = metrics.histogram('saucebot_maintenance_seconds', 'Maintenance job run time', job=name)
+        self.failures = metrics.counter('saucebot_maintenance_failures_total', 'Failed maintenance runs', job=name)
+
+
+class MaintenanceScheduler:
+    """
+    Runs periodic maintenance jobs in the background, one at a time, recording how long each run takes
+    """
+
+    def __init__(self):
+        self._jobs = []  # type: typing.List[MaintenanceJob]
+        self._task = None  # type: typing.Optional[asyncio.Task]
+
+    def add_job(self, name: str, interval: float, function: typing.Callable[[], typing.Awaitable]) -> None:
+        """
+        Register a job
+        Args:
+            name (str): Name of the job, used in logs and metrics
+            interval (float): Seconds between runs
+            function (typing.Callable[[], typing.Awaitable]): Coroutine function performing the job
+        """
+        self._jobs.append(MaintenanceJob(name, interval, function))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = bot.loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        await bot.wait_until_ready()
+
+        while not bot.is_closed():
+            for job in self._jobs:
+                if job.next_run <= monotonic():
+                    await self._run_job(job)
+
+            next_run = min((j.next_run for j in self._jobs), default=monotonic() + 60)
+            await asyncio.sleep(max(next_run - monotonic(), 1))
+
+    async def _run_job(self, job: MaintenanceJob) -> None:
+        start = perf_counter()
+        # noinspection PyBroadException
+        try:
+            await job.function()
+        except Exception:
+            job.failures.inc()
+            _log.exception(f'[SYSTEM] Maintenance job "{job.name}" failed')
+        finally:
+            elapsed = perf_counter() - start
+            job.duration.observe(elapsed)
+            job.next_run = monotonic() + job.interval
+            _log.debug(f'[SYSTEM] Maintenance job "{job.name}" finished in {elapsed:.3f}s')
+
+
+async def purge_in_batches(name: str, purge: typing.Callable[[int, int], typing.Awaitable[int]], cutoff: int,
+                           batch_size: int = 1000, pause: float = 0.1) -> int:
+    """
+    Repeatedly deletes batches of expired rows until none remain
+    Args:
+        name (str): What is being purged, used in logs and metrics
+        purge (typing.Callable[[int, int], typing.Awaitable[int]]): Model method deleting one batch of rows
+        cutoff (int): Unix timestamp; older rows are deleted
+        batch_size (int): Maximum number of rows deleted per batch
+        pause (float): Seconds to wait between batches, giving other queries a turn at the database
+
+    Returns:
+        int: The total number of rows deleted
+    """
+    start = perf_counter()
+    total = 0
+    while True:
+        deleted = await purge(cutoff, batch_size)
+        total += deleted
+        if deleted < batch_size:
+            break
+
+        await asyncio.sleep(pause)
+
+    metrics.counter('saucebot_purged_rows_total', 'Expired database rows purged', table=name).inc(total)
+    _log.info(f'[SYSTEM] Purged {total} expired {name} row(s) in {perf_counter() - start:.2f}s')
+    return total
+
+
+async def purge_database() -> None:
+    """
+    Purge expired cache entries, old guild quotas and rate limits and (optionally) old query logs
+    """
+    batch_size = config.getint('Database', 'purge_batch_size', fallback=1000)
+    cache_cutoff = int(time()) - config.getint('Cache', 'ttl', fallback=86400)
+    await purge_in_batches('SauceCache', SauceCache.purge_cache, cache_cutoff, batch_size)
+    await purge_in_batches('SauceHashCache', SauceHashCache.purge_cache, cache_cutoff, batch_size)
+
+    # Quotas are only needed for the current day
+    await purge_in_batches('GuildQuotas', GuildQuotas.purge, int(time()) - 86400, batch_size)
+    # Rate limit windows are only a few minutes long
+    await purge_in_batches('RateLimitHits', RateLimitHits.purge, int(time()) - 3600, batch_size)
+
+    retention_days = config.getint('Database', 'query_retention_days', fallback=0)
+    if retention_days:
+        await purge_in_batches('SauceQueries', SauceQueries.purge, int(time()) - (retention_days * 86400), batch_size)
+
+
+scheduler = MaintenanceScheduler()
+scheduler.add_job('purge_database', config.getfloat('Database', 'purge_interval', fallback=21600.0), purge_database)
+
+# Only needed when guild settings may be changed by another process sharing the database, which is always the case
+# for the worker processes of a cluster
+_guild_reload_interval = config.getfloat('Database', 'guild_metadata_reload_interval', fallback=0.0)
+if not _guild_reload_interval and config.getint('Cluster', 'processes', fallback=1) > 1:
+    _guild_reload_interval = 60.0
+if _guild_reload_interval:
+    scheduler.add_job('reload_guild_metadata', _guild_reload_interval, load_guild_metadata)
@@ -0,0 +1,205 @@
+import bisect
+import contextlib
+import typing
+from time import perf_counter
+
+# All metrics registered by the application, keyed by their name and labels
+_registry = {}  # type: typing.Dict[typing.Tuple[str, typing.Tuple], 'Metric']
+# Functions called to update derived metrics before they are collected
+_collectors = []  # type: typing.List[typing.Callable[[], None]]
+
+
+class Metric:
+    """
+    Base class for all in-process metrics
+    """
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, description: str = '', labels: typing.Optional[dict] = None):
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+
+
+class Counter(Metric):
+    """
+    A monotonically increasing value, such as the number of cache hits
+    """
+    TYPE = 'counter'
+
+    def __init__(self, name: str, description: str = '', labels: typing.Optional[dict] = None):
+        super().__init__(name, description, labels)
+        self.value = 0
+
+    def inc(self, amount: typing.Union[int, float] = 1) -> None:
+        self.value += amount
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down, such as a queue depth
+    """
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, description: str = '', labels: typing.Optional[dict] = None):
+        super().__init__(name, description, labels)
+        self.value = 0
+
+    def set(self, value: typing.Union[int, float]) -> None:
+        self.value = value
+
+    def inc(self, amount: typing.Union[int, float] = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: typing.Union[int, float] = 1) -> None:
+        self.value -= amount
+
+
+class Histogram(Metric):
+    """
+    A bucketed distribution of observed values, generally latencies in seconds
+    """
+    TYPE = 'histogram'
+    DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, description: str = '', labels: typing.Optional[dict] = None,
+                 buckets: typing.Optional[typing.Sequence[float]] = None):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+        self.bucket_counts = [0] * (len(self.buckets) + 1)  # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent: float) -> float:
+        """
+        Estimate a percentile from the bucket counts (returns the upper bound of the matching bucket)
+        Args:
+            percent (float): A value between 0 and 100
+
+        Returns:
+            float
+        """
+        if not self.count:
+            return 0.0
+
+        target = self.count * (percent / 100)
+        seen = 0
+        for index, bucket_count in enumerate(self.bucket_counts):
+            seen += bucket_count
+            if seen >= target:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+
+        return float('inf')
+
+
+def _get_or_create(metric_class, name: str, description: str, labels: dict, **kwargs):
+    key = (name, tuple(sorted(labels.items())))
+    metric = _registry.get(key)
+    if metric is None:
+        metric = metric_class(name, description, labels, **kwargs)
+        _registry[key] = metric
+
+    return metric
+
+
+def counter(name: str, description: str = '', **labels) -> Counter:
+    """
+    Get or register a counter with the specified name and labels
+    """
+    return _get_or_create(Counter, name, description, labels)
+
+
+def gauge(name: str, description: str = '', **labels) -> Gauge:
+    """
+    Get or register a gauge with the specified name and labels
+    """
+    return _get_or_create(Gauge, name, description, labels)
+
+
+def histogram(name: str, description: str = '', buckets: typing.Optional[typing.Sequence[float]] = None,
+              **labels) -> Histogram:
+    """
+    Get or register a histogram with the specified name and labels
+    """
+    return _get_or_create(Histogram, name, description, labels, buckets=buckets)
+
+
+@contextlib.contextmanager
+def timer(name: str, description: str = '', **labels):
+    """
+    Observe the time spent inside the context in a histogram with the specified name and labels
+    """
+    metric = histogram(name, description, **labels)
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        metric.observe(perf_counter() - start)
+
+
+def register_collector(collector: typing.Callable[[], None]) -> None:
+    """
+    Register a function that updates derived metrics (e.g. ratios) just before metrics are collected
+    """
+    _collectors.append(collector)
+
+
+def find(name: str) -> typing.List[Metric]:
+    """
+    Returns every registered metric with the specified name, whatever its labels
+    """
+    return [m for m in list(_registry.values()) if m.name == name]
+
+
+def collect() -> typing.List[Metric]:
+    """
+    Returns every registered metric
+    """
+    for collector in _collectors:
+        collector()
+
+    return list(_registry.values())
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+
+    def escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in sorted(labels.items())) + '}'
+
+
+def render() -> str:
+    """
+    Renders every registered metric in the Prometheus text exposition format
+    """
+    families = {}  # type: typing.Dict[str, typing.List[Metric]]
+    for metric in collect():
+        families.setdefault(metric.name, []).append(metric)
+
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f"# HELP {name} {family[0].description}")
+        lines.append(f"# TYPE {name} {family[0].TYPE}")
+        for metric in family:
+            if isinstance(metric, Histogram):
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + (float('inf'),), metric.bucket_counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels({**metric.labels, 'le': le})} {cumulative}")
+
+                lines.append(f"{name}_sum{_format_labels(metric.labels)} {metric.sum}")
+                lines.append(f"{name}_count{_format_labels(metric.labels)} {metric.count}")
+            else:
+                lines.append(f"{name}{_format_labels(metric.labels)} {metric.value}")
+
+    return '\n'.join(lines) + '\n'
@@ -1,22 +1,88 @@
+import asyncio
+import functools
 import hashlib
 import typing
-from time import time
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
 
 import discord
-from discord.ext.commands import Context
 from pony.orm import *
 from pysaucenao import GenericSource
 
+from saucebot import metrics
+from saucebot.cache import GuildMetadataCache
 from saucebot.config import config
+from saucebot.imaging import hamming_distance, hash_segments
 from saucebot.log import log
 
 db = Database()
 
+# Database queries are executed in a dedicated, bounded thread pool so a slow database never blocks the event loop
+_executor = ThreadPoolExecutor(max_workers=config.getint('Database', 'workers', fallback=4),
+                               thread_name_prefix='saucebot-db')
+
+@db.on_connect(provider='sqlite')
+def _tune_sqlite(_, connection):
+    """
+    Use write-ahead logging so reads never wait on writes, and trade a little durability on power loss (never on a
+    crash) for far fewer fsyncs
+    """
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.execute(f"PRAGMA mmap_size = {config.getint('Database', 'sqlite_mmap_size', fallback=268435456)}")
+    # Negative cache sizes are in KiB rather than pages
+    cursor.execute(f"PRAGMA cache_size = -{config.getint('Database', 'sqlite_cache_size', fallback=32768)}")
+
+
 if config.has_section('MySQL'):
     db.bind(provider='mysql', host=config.get('MySQL', 'hostname'), user=config.get('MySQL', 'username'),
             passwd=config.get('MySQL', 'password'), db=config.get('MySQL', 'database'), charset='utf8mb4')
 else:
-    db.bind(provider='sqlite', filename='database.sqlite', create_db=True)
+    db.bind(provider='sqlite', filename=config.get('Database', 'sqlite_filename', fallback='database.sqlite'),
+            create_db=True)
+
+
+def db_task(function):
+    """
+    Runs the decorated database function in the database executor and makes it awaitable
+    The time spent waiting on each call (including time queued for a worker) is recorded in a latency histogram
+    """
+    name = getattr(function, '__wrapped__', function).__qualname__
+    histogram = metrics.histogram('saucebot_db_query_seconds', 'Database query latency', query=name)
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_event_loop()
+        start = perf_counter()
+        try:
+            return await loop.run_in_executor(_executor, functools.partial(function, *args, **kwargs))
+        finally:
+            histogram.observe(perf_counter() - start)
+
+    return wrapper
+
+
+# noinspection PyTypeChecker
+def _purge_before(entity: typing.Type[db.Entity], attribute: str, cutoff: int, batch_size: int) -> int:
+    """
+    Delete up to batch_size rows of an entity whose attribute is below the cutoff
+    Must be called within a db_session. Callers purge each batch in its own short transaction, so purging never holds
+    the database for long.
+    Args:
+        entity (typing.Type[db.Entity]): The entity to purge
+        attribute (str): Name of the (indexed) attribute compared to the cutoff
+        cutoff (int): Rows with a lower value are deleted
+        batch_size (int): Maximum number of rows to delete
+
+    Returns:
+        int: The number of rows deleted
+    """
+    ids = select(e.id for e in entity if getattr(e, attribute) < cutoff)[:batch_size]
+    if ids:
+        delete(e for e in entity if e.id in ids)
+
+    return len(ids)
 
 
 # noinspection PyMethodParameters
@@ -24,20 +90,7 @@ class Servers(db.Entity):
     server_id = Required(int, size=64, unique=True)
     api_key = Optional(str, 40)
 
-    @db_session
-    def lookup_guild(guild: discord.Guild) -> typing.Optional[str]:
-        """
-        Gets the SauceNao API key for the specified guild
-        Args:
-            guild (discord.Guild):
-
-        Returns:
-            typing.Optional[str]
-        """
-        server = Servers.get(server_id=guild.id)
-        if server:
-            return server.api_key
-
+    @db_task
     @db_session
     def register(guild: discord.Guild, api_key: str):
         # Delete any existing entry for this server
@@ -48,6 +101,19 @@ class Servers(db.Entity):
         Servers(server_id=guild.id, api_key=api_key)
         log.info(f'Registering API key for server {guild.name} ({guild.id})')
 
+        commit()
+        guild_metadata.set_api_key(guild.id, api_key)
+
+    @db_task
+    @db_session
+    def api_keys() -> typing.Dict[int, str]:
+        """
+        Gets every registered API key
+        Returns:
+            typing.Dict[int, str]: API keys, keyed by guild ID
+        """
+        return dict(select((s.server_id, s.api_key) for s in Servers if s.api_key))
+
 
 # noinspection PyMethodParameters
 class SauceCache(db.Entity):
@@ -57,6 +123,7 @@ class SauceCache(db.Entity):
     result          = Required(Json)
     result_class    = Required(str, 250)
 
+    @db_task
     @db_session
     def fetch(url: str):
         """
@@ -72,6 +139,7 @@ class SauceCache(db.Entity):
 
         return SauceCache.get(url_hash=h.hexdigest())
 
+    @db_task
     @db_session
     def add_or_update(url: str, result: GenericSource):
         """
@@ -97,61 +165,151 @@ class SauceCache(db.Entity):
         return SauceCache(url_hash=h.hexdigest(), created_at=now, header=result.header, result=result.data,
                           result_class=type(result).__name__)
 
+    @db_task
+    @db_session
+    def purge_cache(cutoff: int, batch_size: int = 1000) -> int:
+        """
+        Purge up to batch_size cache entries created before the supplied cutoff
+        Args:
+            cutoff (int): Unix timestamp; older entries are deleted
+            batch_size (int): Maximum number of entries to delete
+
+        Returns:
+            int: The number of entries deleted
+        """
+        return _purge_before(SauceCache, 'created_at', cutoff, batch_size)
+
+
+# noinspection PyMethodParameters
+class SauceHashCache(db.Entity):
+    image_hash      = Required(str, 16, unique=True)
+    hash_a          = Required(int, size=32, index=True)
+    hash_b          = Required(int, size=32, index=True)
+    hash_c          = Required(int, size=32, index=True)
+    hash_d          = Required(int, size=32, index=True)
+    created_at      = Required(int, size=32, index=True)
+    header          = Required(Json)
+    result          = Required(Json)
+    result_class    = Required(str, 250)
+
     # noinspection PyTypeChecker
+    @db_task
     @db_session
-    def purge_cache(cutoff_minutes: int = 86400) -> None:
+    def fetch(image_hash: int, max_distance: int = 2):
         """
-        Purge cache entries older than the supplied cutoff
+        Fetch the closest cached result for a perceptual image hash, if available
+        Args:
+            image_hash (int): 64-bit perceptual hash of the image
+            max_distance (int): Maximum number of differing bits for an entry to be a match. Must be 3 or lower.
+
         Returns:
-            None
+            typing.Optional[SauceHashCache]
         """
-        cutoff = int(time()) - (cutoff_minutes * 60)
-        delete(c for c in SauceCache if c.created_at < cutoff)
+        # An exact match is always the best match, and is a single unique index lookup
+        exact = SauceHashCache.get(image_hash=f"{image_hash:016x}")
+        if exact:
+            log.debug(f"Perceptual cache match for {image_hash:016x}: {exact.image_hash} (exact)")
+            return exact
+
+        a, b, c, d = hash_segments(image_hash)
+        candidates = select(
+            e for e in SauceHashCache if e.hash_a == a or e.hash_b == b or e.hash_c == c or e.hash_d == d
+        ).order_by(lambda e: desc(e.created_at))[:100]
+
+        best, best_distance = None, None
+        for candidate in candidates:
+            distance = hamming_distance(image_hash, int(candidate.image_hash, 16))
+            if distance <= max_distance and (best_distance is None or distance < best_distance):
+                best, best_distance = candidate, distance
+
+        if best:
+            log.debug(f"Perceptual cache match for {image_hash:016x}: {best.image_hash} ({best_distance} bit(s) off)")
+
+        return best
+
+    @db_task
+    @db_session
+    def add_or_update(image_hash: int, result: GenericSource):
+        """
+        Cache a SauceNao result by the perceptual hash of the image that was looked up
+        Args:
+            image_hash (int): 64-bit perceptual hash of the image
+            result (GenericSource): Result to cache
+
+        Returns:
+            SauceHashCache
+        """
+        now = int(time())
+        hex_hash = f"{image_hash:016x}"
+
+        cache = SauceHashCache.get(image_hash=hex_hash)
+        if cache:
+            log.debug(f"Refreshing perceptual cache entry for {hex_hash}")
+            cache.delete()
+
+        a, b, c, d = hash_segments(image_hash)
+        return SauceHashCache(image_hash=hex_hash, hash_a=a, hash_b=b, hash_c=c, hash_d=d, created_at=now,
+                              header=result.header, result=result.data, result_class=type(result).__name__)
+
+    @db_task
+    @db_session
+    def purge_cache(cutoff: int, batch_size: int = 1000) -> int:
+        """
+        Purge up to batch_size cache entries created before the supplied cutoff
+        Args:
+            cutoff (int): Unix timestamp; older entries are deleted
+            batch_size (int): Maximum number of entries to delete
+
+        Returns:
+            int: The number of entries deleted
+        """
+        return _purge_before(SauceHashCache, 'created_at', cutoff, batch_size)
 
 
 # noinspection PyMethodParameters
 class SauceQueries(db.Entity):
     server_id       = Required(int, size=64)
-    user_id         = Required(int, size=64, index=True)
+    user_id         = Required(int, size=64)
     url_hash        = Required(str, 32, index=True)
     queried         = Optional(int, size=32, index=True)
+    composite_index(user_id, queried)
 
+    @db_task
     @db_session
-    def log(ctx: Context, url: str):
+    def log_many(rows: typing.List[dict]) -> int:
         """
-        Gets the SauceNao API key for the specified guild
+        Log a batch of queries in a single transaction
         Args:
-            ctx (Context):
-            url (str): URL to the image that was queries. Will be md5 hashed and stored in the database.
+            rows (typing.List[dict]): server_id, user_id, url_hash and queried values for each query
 
         Returns:
-            SauceQueries
+            int: The number of queries logged
         """
-        now = int(time())
+        for row in rows:
+            SauceQueries(**row)
 
-        h = hashlib.new('md5')
-        h.update(url.encode())
-
-        log.debug(f"Logging query from user {ctx.author} with URL hash {h.hexdigest()}")
-        return SauceQueries(server_id=ctx.guild.id, user_id=ctx.author.id, url_hash=h.hexdigest(), queried=now)
+        return len(rows)
 
     # noinspection PyTypeChecker
+    @db_task
     @db_session
-    def user_count(user: discord.User, minutes: int = 5) -> int:
+    def user_history(user: discord.User, minutes: int = 5, limit: int = 100) -> typing.List[int]:
         """
-        Get a count of how many requests the specified discord user has made in the specified timespan
+        Get the timestamps of the most recent requests the specified discord user has made in the specified timespan
         Args:
             user (discord.User):
             minutes (int):
+            limit (int): Maximum number of timestamps to return
 
         Returns:
-            int
+            typing.List[int]
         """
-        log.debug(f"Counting how many queries {user} has made in the last {minutes} minute(s)")
         cutoff = int(time()) - (minutes * 60)
-        return count(q for q in SauceQueries if q.queried > cutoff)
+        return select(q.queried for q in SauceQueries if q.user_id == user.id and q.queried > cutoff) \
+            .order_by(desc(1))[:limit]
 
     # noinspection PyTypeChecker
+    @db_task
     @db_session
     def count_total() -> int:
         """
@@ -164,26 +322,224 @@ class SauceQueries(db.Entity):
 
         return total
 
+    @db_task
+    @db_session
+    def purge(cutoff: int, batch_size: int = 1000) -> int:
+        """
+        Purge up to batch_size logged queries made before the supplied cutoff
+        Args:
+            cutoff (int): Unix timestamp; older queries are deleted
+            batch_size (int): Maximum number of queries to delete
 
-class GuildBanlist(db.Entity):
-    server_id   = Required(int, size=64, index=True)
-    banned_on   = Required(int, size=32)
-    reason      = Optional(str, max_len=3000)
+        Returns:
+            int: The number of queries deleted
+        """
+        return _purge_before(SauceQueries, 'queried', cutoff, batch_size)
+
+
+# noinspection PyMethodParameters
+class GuildQuotas(db.Entity):
+    server_id   = Required(int, size=64)
+    day         = Required(int, size=32)
+    queries     = Required(int, size=32, default=0)
+    composite_key(server_id, day)
+
+    @db_task
+    @db_session(retry=3)
+    def consume(guild: discord.Guild, limit: int) -> bool:
+        """
+        Consume a query from the specified guilds daily quota
+        Quotas are tracked per UTC day and stored in the database, so they survive restarts and are shared between
+        every process using the same database.
+        Args:
+            guild (discord.Guild):
+            limit (int): The number of queries the guild may perform per day
 
+        Returns:
+            bool: Returns False if the guild has already exhausted its quota for the day
+        """
+        day = int(time()) // 86400
+        quota = GuildQuotas.get_for_update(server_id=guild.id, day=day)
+        if not quota:
+            quota = GuildQuotas(server_id=guild.id, day=day)
+
+        if quota.queries >= limit:
+            log.debug(f"Guild {guild.id} has used all {limit} of its queries for the day")
+            return False
+
+        quota.queries += 1
+        return True
+
+    @db_task
     @db_session
-    def check(guild: typing.Union[discord.Guild, int]) -> bool:
+    def purge(cutoff: int, batch_size: int = 1000) -> int:
         """
-        Check whether the specified guild has been banned
+        Purge up to batch_size quota records for days before the supplied cutoff
         Args:
-            guild (typing.Union[discord.Guild, int]): The guild / server that is being checked.
+            cutoff (int): Unix timestamp; quotas for earlier days are deleted
+            batch_size (int): Maximum number of records to delete
 
         Returns:
-            bool
+            int: The number of records deleted
         """
-        guild_id = guild.id if isinstance(guild, discord.Guild) else guild
-        banned = GuildBanlist.get(server_id=guild_id)
-        return True if banned else False
+        return _purge_before(GuildQuotas, 'day', cutoff // 86400, batch_size)
+
+
+# noinspection PyMethodParameters
+class RateLimitHits(db.Entity):
+    limiter     = Required(str, 32)
+    key         = Required(int, size=64)
+    hit_at      = Required(int, size=32)
+    composite_index(limiter, key, hit_at)
+
+    # noinspection PyTypeChecker
+    @db_task
+    @db_session(retry=3, immediate=True)
+    def acquire(limiter: str, key: int, limit: int, since: int, hit_at: int) -> bool:
+        """
+        Record an action for a key, unless it has already performed `limit` actions since the specified time
+        The key's recent actions are locked while they are counted, so concurrent callers are serialized.
+        Args:
+            limiter (str): Name of the rate limiter
+            key (int): The rate limited key (generally a user ID)
+            limit (int): Maximum number of actions allowed since the specified time
+            since (int): Unix timestamp
+            hit_at (int): Unix timestamp of the action
+
+        Returns:
+            bool: Returns False if the key is limited, in which case nothing is recorded
+        """
+        hits = select(h for h in RateLimitHits if h.limiter == limiter and h.key == key and h.hit_at > since) \
+            .for_update()[:limit]
+        if len(hits) >= limit:
+            return False
+
+        RateLimitHits(limiter=limiter, key=key, hit_at=hit_at)
+        return True
 
+    @db_task
+    @db_session
+    def purge(cutoff: int, batch_size: int = 1000) -> int:
+        """
+        Purge up to batch_size actions recorded before the supplied cutoff
+        Args:
+            cutoff (int): Unix timestamp; older actions are deleted
+            batch_size (int): Maximum number of rows to delete
+
+        Returns:
+            int: The number of rows deleted
+        """
+        return _purge_before(RateLimitHits, 'hit_at', cutoff, batch_size)
+
+
+# noinspection PyMethodParameters
+class BotStatistics(db.Entity):
+    name    = PrimaryKey(str, 64)
+    value   = Required(int, size=64, default=0)
+
+    @db_task
+    @db_session
+    def load(name: str) -> typing.Optional[int]:
+        """
+        Get the stored value of a statistic
+        Args:
+            name (str):
+
+        Returns:
+            typing.Optional[int]: None if the statistic has never been stored
+        """
+        stat = BotStatistics.get(name=name)
+        return stat.value if stat else None
+
+    @db_task
+    @db_session(retry=3)
+    def seed(name: str, value: int) -> int:
+        """
+        Store the initial value of a statistic, unless it has already been stored
+        Args:
+            name (str):
+            value (int):
+
+        Returns:
+            int: The stored value
+        """
+        stat = BotStatistics.get(name=name)
+        if not stat:
+            log.info(f"Seeding statistic {name} with {value}")
+            stat = BotStatistics(name=name, value=value)
+
+        return stat.value
+
+    @db_task
+    @db_session(retry=3)
+    def increment(name: str, amount: int) -> int:
+        """
+        Atomically add to a statistic
+        Only the change is written, so several processes can share a statistic without overwriting each other.
+        Args:
+            name (str):
+            amount (int):
+
+        Returns:
+            int: The new value
+        """
+        stat = BotStatistics.get_for_update(name=name)
+        if not stat:
+            stat = BotStatistics(name=name, value=0)
+
+        stat.value += amount
+        return stat.value
+
+    @db_task
+    @db_session(retry=3)
+    def store(name: str, value: int) -> None:
+        """
+        Overwrite the stored value of a statistic
+        Args:
+            name (str):
+            value (int):
+
+        Returns:
+            None
+        """
+        stat = BotStatistics.get_for_update(name=name)
+        if stat:
+            stat.value = value
+        else:
+            BotStatistics(name=name, value=value)
+
+    @db_task
+    @db_session
+    def cluster_values(name: str, processes: int) -> typing.Dict[int, int]:
+        """
+        Get the values every worker process of a cluster has stored for a statistic
+        Each worker stores its own value as name:cluster_id. Values left behind by workers that no longer exist, after
+        the number of processes has been reduced, are removed.
+        Args:
+            name (str):
+            processes (int): Number of worker processes in the cluster
+
+        Returns:
+            typing.Dict[int, int]: Values by cluster ID
+        """
+        prefix = f"{name}:"
+        values = {}
+        for stat in select(s for s in BotStatistics if s.name.startswith(prefix)):
+            cluster_id = stat.name[len(prefix):]
+            if cluster_id.isdigit() and int(cluster_id) < processes:
+                values[int(cluster_id)] = stat.value
+            else:
+                stat.delete()
+
+        return values
+
+
+class GuildBanlist(db.Entity):
+    server_id   = Required(int, size=64, index=True)
+    banned_on   = Required(int, size=32)
+    reason      = Optional(str, max_len=3000)
+
+    @db_task
     @db_session
     def ban(guild: discord.Guild, reason: typing.Optional[str] = None):
         """
@@ -202,6 +558,10 @@ class GuildBanlist(db.Entity):
         log.warning(f"Guild {guild.name} ({guild.id}) is being added to the server banlist")
         GuildBanlist(server_id=guild.id, banned_on=now, reason=reason)
 
+        commit()
+        guild_metadata.set_banned(guild.id, True)
+
+    @db_task
     @db_session
     def unban(guild: typing.Union[discord.Guild, int]) -> bool:
         """
@@ -221,7 +581,60 @@ class GuildBanlist(db.Entity):
 
         log.warning(f"Guild {guild_id} is being removed from the server banlist")
         entry.delete()
+
+        commit()
+        guild_metadata.set_banned(guild_id, False)
         return True
 
+    @db_task
+    @db_session
+    def banned_guilds() -> typing.List[int]:
+        """
+        Gets the ID's of every banned guild
+        Returns:
+            typing.List[int]
+        """
+        return select(b.server_id for b in GuildBanlist)[:]
+
 
 db.generate_mapping(create_tables=True)
+
+# Indexes made redundant by ones generate_mapping has added to tables created by older versions, as (name, table)
+OBSOLETE_INDEXES = [
+    ('idx_saucequeries__user_id', 'SauceQueries'),
+]
+
+
+@db_session
+def _migrate_indexes() -> None:
+    """
+    Drop indexes that are no longer used from an existing database
+    """
+    quote = db.provider.quote_name
+    for table in {t for _, t in OBSOLETE_INDEXES}:
+        if db.provider_name == 'sqlite':
+            existing = set(db.select("name FROM sqlite_master WHERE type = 'index' AND tbl_name = $table"))
+        else:
+            existing = set(db.select("index_name FROM information_schema.statistics "
+                                     "WHERE table_schema = DATABASE() AND table_name = $table"))
+
+        for name, _table in OBSOLETE_INDEXES:
+            if _table == table and name in existing:
+                log.info(f'Dropping obsolete index {name} on {table}')
+                if db.provider_name == 'sqlite':
+                    db.execute(f"DROP INDEX {quote(name)}")
+                else:
+                    db.execute(f"DROP INDEX {quote(name)} ON {quote(table)}")
+
+
+_migrate_indexes()
+
+# Registered API keys and the guild banlist, cached in memory so commands never have to query them
+guild_metadata = GuildMetadataCache()
+
+
+async def load_guild_metadata() -> None:
+    """
+    (Re)load the guild metadata cache from the database
+    """
+    guild_metadata.load(await Servers.api_keys(), await GuildBanlist.banned_guilds())
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import traceback
+import typing
+from collections import Counter, deque
+from time import monotonic, sleep, time
+
+from aiohttp import web
+
+from saucebot import metrics
+from saucebot.bot import bot
+from saucebot.cluster import ENV_CLUSTER_ID
+from saucebot.config import config
+
+_log = logging.getLogger(__name__)
+
+
+class MetricsServer:
+    """
+    Serves every registered metric over HTTP in the Prometheus text format
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9090):
+        self.host = host
+        self.port = port
+        self._runner = None  # type: typing.Optional[web.AppRunner]
+
+    async def _metrics(self, _: web.Request) -> web.Response:
+        return web.Response(body=metrics.render().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/metrics', self._metrics)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        _log.info(f"[SYSTEM] Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class LoopLagMonitor:
+    """
+    Continuously measures event loop lag: how much later than requested a sleeping task is woken up
+    Anything that blocks the loop (slow callbacks, synchronous I/O, CPU heavy work) shows up as lag, and delays
+    every shard.
+    With a slow callback threshold set, a watchdog thread also watches for the loop stalling. When it does, the stack
+    of the loop thread is captured while it is still blocked, so the offending callback can be identified.
+    """
+
+    def __init__(self, interval: float = 0.5, slow_threshold: float = 0.0, history: int = 50):
+        """
+        Args:
+            interval (float): Seconds between measurements
+            slow_threshold (float): Report callbacks blocking the loop for longer than this many seconds, 0 to disable
+            history (int): Number of slow callbacks remembered
+        """
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.slow_callbacks = deque(maxlen=history)  # type: typing.Deque[typing.Tuple[float, float, str]]
+        self.loop_thread_id = None  # type: typing.Optional[int]
+        self._task = None  # type: typing.Optional[asyncio.Task]
+        self._watchdog = None  # type: typing.Optional[threading.Thread]
+        self._expected_wake = None  # type: typing.Optional[float]
+        self._stalled_stack = None  # type: typing.Optional[str]
+        self._slow_count = metrics.counter('saucebot_slow_callbacks_total', 'Callbacks that blocked the event loop')
+
+        self._last_lag = metrics.gauge('saucebot_event_loop_last_lag_seconds', 'Most recently measured event loop lag')
+        self._lag = metrics.histogram('saucebot_event_loop_lag_seconds', 'Event loop lag')
+
+    def start(self) -> None:
+        """
+        Start monitoring; must be called from the thread running the event loop
+        """
+        if self._task is None:
+            self.loop_thread_id = threading.get_ident()
+            self._task = bot.loop.create_task(self._run())
+
+        if self.slow_threshold and self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch, name='saucebot-loop-watchdog', daemon=True)
+            self._watchdog.start()
+
+    async def _run(self) -> None:
+        while True:
+            # The event loop clock is time.monotonic, so the watchdog thread can compare against it
+            start = monotonic()
+            self._expected_wake = start + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(monotonic() - self._expected_wake, 0.0)
+            self._expected_wake = None
+            self._last_lag.set(lag)
+            self._lag.observe(lag)
+
+            if self._stalled_stack:
+                self._slow_count.inc()
+                self.slow_callbacks.append((time(), lag, self._stalled_stack))
+                _log.warning(f"[SYSTEM] The event loop was blocked for {lag:.3f}s by:\n{self._stalled_stack}")
+                self._stalled_stack = None
+
+    def _watch(self) -> None:
+        """
+        Watchdog thread; captures the loop threads stack when it oversleeps by more than the slow callback threshold
+        """
+        reported = None
+        while self._task is not None:
+            sleep(self.slow_threshold / 4)
+            expected_wake = self._expected_wake
+            if expected_wake is None or expected_wake == reported:
+                continue
+
+            if monotonic() - expected_wake > self.slow_threshold:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None:
+                    self._stalled_stack = ''.join(traceback.format_stack(frame))
+                    reported = expected_wake
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+def sample_stacks(thread_id: int, duration: float = 10.0, interval: float = 0.005) -> typing.Counter[str]:
+    """
+    A sampling profiler; periodically records the stack of a thread (generally the one running the event loop)
+    Run this in another thread. The result can be rendered as a flame graph, or simply read.
+    Args:
+        thread_id (int): The thread to profile
+        duration (float): Seconds to profile for
+        interval (float): Seconds between samples
+
+    Returns:
+        typing.Counter[str]: How many times each stack was sampled, as semicolon separated frames (outermost first)
+    """
+    samples = Counter()  # type: typing.Counter[str]
+    end = monotonic() + duration
+    while monotonic() < end:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stack = traceback.extract_stack(frame)
+            samples[';'.join(f"{f.name} ({os.path.basename(f.filename)}:{f.lineno})" for f in stack)] += 1
+
+        sleep(interval)
+
+    return samples
+
+
+def _update_cache_hit_ratios() -> None:
+    """
+    Derive the hit ratio of every cache from its hit and miss counters
+    """
+    for hits in metrics.find('saucebot_cache_hits_total'):
+        cache = hits.labels['cache']
+        misses = metrics.counter('saucebot_cache_misses_total', 'Cache misses', cache=cache).value
+        total = hits.value + misses
+        metrics.gauge('saucebot_cache_hit_ratio', 'Ratio of cache lookups that were hits',
+                      cache=cache).set(hits.value / total if total else 0.0)
+
+
+metrics.register_collector(_update_cache_hit_ratios)
+
+# Every worker of a cluster serves its own metrics, on consecutive ports
+metrics_server = MetricsServer(
+    config.get('Metrics', 'host', fallback='127.0.0.1'),
+    config.getint('Metrics', 'port', fallback=9090) + int(os.environ.get(ENV_CLUSTER_ID, 0))
+)
+loop_lag_monitor = LoopLagMonitor(
+    slow_threshold=config.getfloat('Bot', 'slow_callback_threshold', fallback=0.1)
+    if config.getboolean('Bot', 'profiling', fallback=False) else 0.0
+)
@@ -0,0 +1,125 @@
+import asyncio
+import hashlib
+import logging
+import typing
+from time import perf_counter, time
+
+from discord.ext.commands import Context
+
+from saucebot import metrics
+from saucebot.bot import bot
+from saucebot.config import config
+from saucebot.models.database import SauceQueries
+
+
+class QueryLogWriter:
+    """
+    Buffers logged queries in memory and writes them to the database in batches
+    A batch is written once it reaches the batch size or the flush interval passes, whichever comes first, so the
+    lookup itself never waits on a database commit.
+    """
+
+    def __init__(self, batch_size: int = 100, flush_interval: float = 5.0, max_queue_size: int = 10000):
+        """
+        Args:
+            batch_size (int): Number of queued queries that triggers an immediate flush
+            flush_interval (float): Maximum seconds a query may wait in the queue
+            max_queue_size (int): Oldest queries are dropped past this size if the database is unavailable
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self._queue = []  # type: typing.List[dict]
+        self._wakeup = None  # type: typing.Optional[asyncio.Event]
+        self._task = None  # type: typing.Optional[asyncio.Task]
+        self._closing = False
+        self._log = logging.getLogger(__name__)
+
+        self._depth = metrics.gauge('saucebot_query_log_queue_depth', 'Queries waiting to be written')
+        self._flush_latency = metrics.histogram('saucebot_query_log_flush_seconds', 'Query log flush latency')
+        self._dropped = metrics.counter('saucebot_query_log_dropped_total', 'Queries dropped from a full queue')
+
+    def log(self, ctx: Context, url: str) -> None:
+        """
+        Queue a query to be logged
+        Args:
+            ctx (Context):
+            url (str): URL to the image that was queried. Will be md5 hashed and stored in the database.
+
+        Returns:
+            None
+        """
+        h = hashlib.new('md5')
+        h.update(url.encode())
+
+        self._log.debug(f"Queueing query from user {ctx.author} with URL hash {h.hexdigest()}")
+        self._queue.append({
+            'server_id': ctx.guild.id, 'user_id': ctx.author.id, 'url_hash': h.hexdigest(), 'queried': int(time())
+        })
+        self._depth.set(len(self._queue))
+
+        if len(self._queue) >= self.batch_size and self._wakeup:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = bot.loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        self._wakeup = asyncio.Event()
+        try:
+            while not self._closing:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+                self._wakeup.clear()
+                await self.flush()
+        finally:
+            # discord.py cancels every task when the bot is interrupted, before any shutdown hooks run
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Write all queued queries to the database
+        """
+        if not self._queue:
+            return
+
+        rows, self._queue = self._queue, []
+        start = perf_counter()
+        # noinspection PyBroadException
+        try:
+            await SauceQueries.log_many(rows)
+        except Exception:
+            self._log.exception(f"Failed to write {len(rows)} queued queries; they will be retried")
+            self._queue = rows + self._queue
+            overflow = len(self._queue) - self.max_queue_size
+            if overflow > 0:
+                del self._queue[:overflow]
+                self._dropped.inc(overflow)
+        finally:
+            self._flush_latency.observe(perf_counter() - start)
+            self._depth.set(len(self._queue))
+
+    async def close(self) -> None:
+        """
+        Stop the background writer and flush anything still queued
+        """
+        self._closing = True
+        if self._task is not None and not self._task.done():
+            if self._wakeup:
+                self._wakeup.set()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+        await self.flush()
+
+
+query_log = QueryLogWriter(
+    batch_size=config.getint('Database', 'query_log_batch_size', fallback=100),
+    flush_interval=config.getfloat('Database', 'query_log_flush_interval', fallback=5.0)
+)
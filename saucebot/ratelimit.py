@@ -0,0 +1,123 @@
+import typing
+from collections import deque
+from time import time
+
+from saucebot.models.database import RateLimitHits
+
+
+class SlidingWindowLimiter:
+    """
+    An in-memory sliding window rate limiter
+    Each key (generally a user ID) may perform `limit` actions within any `window` second span.
+    """
+
+    def __init__(self, limit: int, window: float = 300.0):
+        """
+        Args:
+            limit (int): Maximum number of actions allowed within the window
+            window (float): Length of the window in seconds
+        """
+        self.limit = limit
+        self.window = window
+        self._hits = {}  # type: typing.Dict[typing.Hashable, typing.Deque[float]]
+
+    def is_limited(self, key: typing.Hashable, now: typing.Optional[float] = None) -> bool:
+        """
+        Check whether the specified key has exhausted its limit
+        Only the most recent `limit` actions are ever stored, so this is a constant time check.
+        Args:
+            key (typing.Hashable):
+            now (typing.Optional[float]): The current unix timestamp
+
+        Returns:
+            bool
+        """
+        hits = self._hits.get(key)
+        if not hits or len(hits) < self.limit:
+            return False
+
+        now = now or time()
+        return hits[0] > now - self.window
+
+    def record(self, key: typing.Hashable, timestamp: typing.Optional[float] = None) -> None:
+        """
+        Record an action for the specified key
+        """
+        hits = self._hits.get(key)
+        if hits is None:
+            hits = self._hits[key] = deque(maxlen=self.limit)
+
+        hits.append(timestamp or time())
+
+    def acquire(self, key: typing.Hashable, now: typing.Optional[float] = None) -> bool:
+        """
+        Record an action for the specified key, unless it has exhausted its limit
+        Args:
+            key (typing.Hashable):
+            now (typing.Optional[float]): The current unix timestamp
+
+        Returns:
+            bool: Returns False if the key is limited, in which case nothing is recorded
+        """
+        now = now or time()
+        if self.is_limited(key, now):
+            return False
+
+        self.record(key, now)
+        return True
+
+    def seed(self, key: typing.Hashable, timestamps: typing.Iterable[float]) -> None:
+        """
+        Load previously recorded actions for a key we are not tracking yet, e.g. from the database after a restart
+        """
+        if key in self._hits:
+            return
+
+        self._hits[key] = deque(sorted(timestamps)[-self.limit:] if self.limit else (), maxlen=self.limit)
+
+    def sweep(self, now: typing.Optional[float] = None) -> int:
+        """
+        Forget keys that have no actions within the current window
+        Returns:
+            int: The number of keys removed
+        """
+        cutoff = (now or time()) - self.window
+        stale = [k for k, hits in self._hits.items() if not hits or hits[-1] <= cutoff]
+        for key in stale:
+            del self._hits[key]
+
+        return len(stale)
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        return key in self._hits
+
+    def __len__(self):
+        return len(self._hits)
+
+
+class DatabaseLimiter:
+    """
+    A sliding window rate limiter that keeps its state in the database
+    Slower than the in-memory limiter, but enforces a single limit across every process sharing the database.
+    """
+
+    def __init__(self, name: str, limit: int, window: float = 300.0):
+        """
+        Args:
+            name (str): Name of the limiter, used to keep its actions apart from those of other limiters
+            limit (int): Maximum number of actions allowed within the window
+            window (float): Length of the window in seconds
+        """
+        self.name = name
+        self.limit = limit
+        self.window = window
+
+    async def acquire(self, key: int) -> bool:
+        """
+        Record an action for the specified key, unless it has exhausted its limit
+        The check and the record are a single transaction, so concurrent actions can't all pass the check.
+        Returns:
+            bool: Returns False if the key is limited, in which case nothing is recorded
+        """
+        now = int(time())
+        return await RateLimitHits.acquire(self.name, key, self.limit, int(now - self.window), now)
@@ -7,12 +7,40 @@ from saucebot.cogs.admin import Admin
 from saucebot.cogs.misc import Misc
 from saucebot.cogs.sauce import Sauce
 from saucebot.config import config
+from saucebot.http import transport
+from saucebot.imaging import image_pool
 from saucebot.log import log
+from saucebot.maintenance import scheduler
+from saucebot.models.database import load_guild_metadata
+from saucebot.monitoring import loop_lag_monitor, metrics_server
+from saucebot.querylog import query_log
+from saucebot.stats import stats
+
+# Guild API keys, the banlist and the persistent statistics are needed before the first command can be processed
+bot.loop.run_until_complete(load_guild_metadata())
+bot.loop.run_until_complete(stats.load())
 
 bot.add_cog(Sauce())
 bot.add_cog(Misc())
 bot.add_cog(Admin())
 
+bot.add_shutdown_hook(transport.close)
+bot.add_shutdown_hook(image_pool.close)
+bot.add_shutdown_hook(stats.flush)
+bot.add_shutdown_hook(query_log.close)
+
+scheduler.add_job('flush_statistics', 300, stats.flush)
+scheduler.start()
+query_log.start()
+
+if config.getboolean('Metrics', 'enabled', fallback=False):
+    bot.loop.run_until_complete(metrics_server.start())
+    bot.add_shutdown_hook(metrics_server.close)
+
+if config.getboolean('Metrics', 'enabled', fallback=False) or config.getboolean('Bot', 'profiling', fallback=False):
+    loop_lag_monitor.start()
+    bot.add_shutdown_hook(loop_lag_monitor.close)
+
 
 @bot.event
 async def on_command_error(ctx: commands.Context, error: Exception):
@@ -0,0 +1,337 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import typing
+from collections import Counter
+from time import monotonic
+
+import aiohttp
+from pysaucenao import SauceNao
+from pysaucenao.containers import SauceNaoResults, TestResults
+from pysaucenao.errors import DailyLimitReachedException, SauceNaoException, ShortLimitReachedException
+
+from saucebot import metrics
+
+
+class ApiKeyScheduler:
+    """
+    Schedules requests for a single API key around SauceNao's short (30 second) and long (daily) query limits
+    The remaining counters reported with each response are tracked. Once the short window is exhausted, requests are
+    queued until it resets instead of being sent and rejected, with guilds that have the fewest requests waiting
+    served first. Once the daily budget drops to the reserve, requests are refused without being sent at all.
+    """
+    SHORT_WINDOW = 30.0
+
+    def __init__(self, loop, name: str, max_wait: float = 10.0, daily_reserve: int = 0,
+                 daily_retry: float = 600.0):
+        """
+        Args:
+            loop: The event loop
+            name (str): A display safe name for the API key, used to label metrics
+            max_wait (float): Maximum number of seconds a request may be queued before giving up
+            daily_reserve (int): Stop sending requests once this many daily queries remain
+            daily_retry (float): Seconds to wait before probing the API again after the daily budget runs out
+        """
+        self._loop = loop
+        self.max_wait = max_wait
+        self.daily_reserve = daily_reserve
+        self.daily_retry = daily_retry
+
+        self.short_limit = None  # type: typing.Optional[int]
+        self.long_remaining = None  # type: typing.Optional[int]
+        self._available = None  # type: typing.Optional[int]
+        self._window_reset = 0.0
+        self._daily_blocked_until = 0.0
+        self._in_flight = 0
+
+        self._waiters = []  # type: typing.List[list]
+        self._queued = Counter()  # type: typing.Counter[typing.Hashable]
+        self._sequence = itertools.count()
+        self._wake_handle = None  # type: typing.Optional[asyncio.TimerHandle]
+
+        self._short_gauge = metrics.gauge('saucebot_saucenao_short_remaining', 'Short window queries remaining',
+                                          api_key=name)
+        self._long_gauge = metrics.gauge('saucebot_saucenao_long_remaining', 'Daily queries remaining', api_key=name)
+        self._queue_gauge = metrics.gauge('saucebot_saucenao_queued_requests', 'Requests waiting on the short limit',
+                                          api_key=name)
+
+    def _has_capacity(self) -> bool:
+        if self._window_reset <= monotonic():
+            self._available = self.short_limit
+
+        return self._available is None or self._available > 0
+
+    def _take(self) -> None:
+        now = monotonic()
+        if self._window_reset <= now:
+            self._window_reset = now + self.SHORT_WINDOW
+
+        if self._available is not None:
+            self._available -= 1
+
+    async def acquire(self, queue_key: typing.Hashable = None) -> None:
+        """
+        Wait until a request may be sent
+        Args:
+            queue_key (typing.Hashable): Requests are ranked by how many others with the same key (guild) are queued
+
+        Raises:
+            DailyLimitReachedException: The daily budget has been exhausted
+            ShortLimitReachedException: The request could not be scheduled within the maximum wait
+        """
+        if self._daily_blocked_until > monotonic():
+            raise DailyLimitReachedException('Daily API budget exhausted; request was not sent')
+
+        if not self._waiters and self._has_capacity():
+            self._take()
+            return
+
+        future = self._loop.create_future()
+        heapq.heappush(self._waiters, [self._queued[queue_key], next(self._sequence), future])
+        self._queued[queue_key] += 1
+        self._queue_gauge.set(len(self._waiters))
+        self._schedule_wake()
+
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            raise ShortLimitReachedException('Timed out waiting for the short API limit to reset')
+        finally:
+            self._queued[queue_key] -= 1
+            if not self._queued[queue_key]:
+                del self._queued[queue_key]
+
+    def _schedule_wake(self) -> None:
+        if self._wake_handle is None and self._waiters:
+            delay = max(self._window_reset - monotonic(), 0)
+            self._wake_handle = self._loop.call_later(delay, self._wake)
+
+    def _wake(self) -> None:
+        """
+        Hand any available capacity to queued requests, in order of rank
+        """
+        # Also called directly when a response reports more capacity, in which case the pending timer is replaced
+        if self._wake_handle is not None:
+            self._wake_handle.cancel()
+            self._wake_handle = None
+
+        while self._waiters and self._has_capacity():
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():  # Timed out or cancelled
+                continue
+
+            self._take()
+            future.set_result(None)
+
+        self._queue_gauge.set(len(self._waiters))
+        self._schedule_wake()
+
+    def update(self, results: SauceNaoResults) -> None:
+        """
+        Update our limits from the remaining query counters of a response
+        """
+        self.short_limit = int(results.short_limit)
+        self.long_remaining = int(results.long_remaining)
+        self._available = max(int(results.short_remaining) - self._in_flight, 0)
+        self._short_gauge.set(results.short_remaining)
+        self._long_gauge.set(results.long_remaining)
+
+        if self.long_remaining <= self.daily_reserve:
+            self._daily_blocked_until = monotonic() + self.daily_retry
+
+        # The response may report more capacity than we assumed, which queued requests can use right away
+        if self._waiters:
+            self._wake()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, queue_key: typing.Hashable = None):
+        """
+        Acquire a request slot for the duration of the context, tracking any limits reported by the API
+        """
+        await self.acquire(queue_key)
+        self._in_flight += 1
+        try:
+            yield
+        except ShortLimitReachedException:
+            self._available = 0
+            self._window_reset = max(self._window_reset, monotonic() + self.SHORT_WINDOW)
+            self._short_gauge.set(0)
+            raise
+        except DailyLimitReachedException:
+            self._daily_blocked_until = monotonic() + self.daily_retry
+            self._long_gauge.set(0)
+            raise
+        finally:
+            self._in_flight -= 1
+
+    @property
+    def idle(self) -> bool:
+        return not self._waiters and not self._in_flight
+
+
+class PooledSauceNao(SauceNao):
+    """
+    A SauceNao client that sends its requests through a shared, long-lived session
+    The stock client opens (and tears down) a new session, and therefore a new connection, for every request.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, scheduler: ApiKeyScheduler, **kwargs):
+        super().__init__(**kwargs)
+        self._session = session
+        self.scheduler = scheduler
+        self.last_used = monotonic()
+
+    async def from_url(self, url: str, queue_key: typing.Hashable = None) -> SauceNaoResults:
+        """
+        Look up the source of an image on the internet
+        Args:
+            url (str): Web URL to an image
+            queue_key (typing.Hashable): Key (generally a guild ID) used to rank this request if it has to be queued
+
+        Returns:
+            SauceNaoResults
+        """
+        self.last_used = monotonic()
+        params = self.params.copy()
+        params['url'] = url
+
+        async with self.scheduler.slot(queue_key):
+            self._log.debug(f"Executing SauceNAO API request on URL: {url}")
+            status_code, response = await self._fetch(self._session, self.API_URL, params)
+            self._verify_request(status_code, response)
+
+        results = SauceNaoResults(response, self._min_similarity, self._priority, self._priority_tolerance, self._loop)
+        self.scheduler.update(results)
+        return results
+
+    async def from_file(self, path_or_fh: typing.Union[str, typing.BinaryIO],
+                        queue_key: typing.Hashable = None) -> SauceNaoResults:
+        """
+        Look up the source of an image on the local filesystem
+        Args:
+            path_or_fh (typing.Union[str, typing.BinaryIO]): Path to the file to open or a file like object
+            queue_key (typing.Hashable): Key (generally a guild ID) used to rank this request if it has to be queued
+
+        Returns:
+            SauceNaoResults
+        """
+        self.last_used = monotonic()
+        params = self.params.copy()
+
+        async with self.scheduler.slot(queue_key):
+            self._log.debug(f"Executing SauceNAO API request on local file: {path_or_fh}")
+            if isinstance(path_or_fh, str):
+                with open(path_or_fh, 'rb') as fh:
+                    params['file'] = fh
+                    status_code, response = await self._post(self._session, self.API_URL, params)
+            else:
+                params['file'] = path_or_fh
+                status_code, response = await self._post(self._session, self.API_URL, params)
+
+            self._verify_request(status_code, response)
+
+        results = SauceNaoResults(response, self._min_similarity, self._priority, self._priority_tolerance, self._loop)
+        self.scheduler.update(results)
+        return results
+
+    async def test(self) -> TestResults:
+        """
+        Executes a test query and returns account information for the provided API key
+        Returns:
+            TestResults
+        """
+        self.last_used = monotonic()
+        params = self.params.copy()
+        params['testmode'] = '1'
+        params['numres'] = '1'
+        params['url'] = 'http://saucenao.com/images/static/banner.gif'
+
+        self._log.debug('Executing a test SauceNao API request')
+        status_code, response = await self._fetch(self._session, self.API_URL, params)
+
+        # For test queries, we just grab and store the exception on failure
+        error = None
+        try:
+            self._verify_request(status_code, response)
+        except SauceNaoException as _error:
+            error = _error
+
+        return TestResults(response, error)
+
+
+class SauceNaoPool:
+    """
+    A registry of reusable SauceNao clients, keyed by API key
+    Every client shares a single pooled session with keep-alive, and clients that go unused are evicted.
+    """
+
+    def __init__(self, loop, session: aiohttp.ClientSession, idle_timeout: float = 900.0,
+                 queue_timeout: float = 10.0, daily_reserve: int = 0, **client_kwargs):
+        """
+        Args:
+            loop: The event loop
+            session (aiohttp.ClientSession): The session all SauceNao requests are sent through
+            idle_timeout (float): Seconds a client may go unused before it is evicted
+            queue_timeout (float): Maximum seconds a request may wait for the short API limit to reset
+            daily_reserve (int): Stop sending requests with a key once this many daily queries remain
+            **client_kwargs: Arguments passed to every SauceNao client (e.g. min_similarity and priority)
+        """
+        self._loop = loop
+        self._queue_timeout = queue_timeout
+        self._daily_reserve = daily_reserve
+        self._idle_timeout = idle_timeout
+        self._client_kwargs = client_kwargs
+        self._clients = {}  # type: typing.Dict[typing.Optional[str], PooledSauceNao]
+        self.session = session
+        self._next_sweep = monotonic() + 60
+        self._log = logging.getLogger(__name__)
+
+    def get(self, api_key: typing.Optional[str]) -> PooledSauceNao:
+        """
+        Get the SauceNao client for the specified API key, creating it if necessary
+        Args:
+            api_key (typing.Optional[str]):
+
+        Returns:
+            PooledSauceNao
+        """
+        if monotonic() >= self._next_sweep:
+            self.evict_idle()
+
+        client = self._clients.get(api_key)
+        if client is None:
+            scheduler = ApiKeyScheduler(self._loop, self._display_key(api_key), self._queue_timeout,
+                                        self._daily_reserve)
+            client = PooledSauceNao(self.session, scheduler, api_key=api_key, loop=self._loop, **self._client_kwargs)
+            self._clients[api_key] = client
+
+        return client
+
+    def evict_idle(self) -> int:
+        """
+        Remove clients that have not been used within the idle timeout
+        Returns:
+            int: The number of clients evicted
+        """
+        cutoff = monotonic() - self._idle_timeout
+        idle = [k for k, c in self._clients.items() if c.last_used < cutoff and c.scheduler.idle]
+        for api_key in idle:
+            del self._clients[api_key]
+
+        if idle:
+            self._log.debug(f"Evicted {len(idle)} idle SauceNao client(s)")
+
+        self._next_sweep = monotonic() + 60
+        return len(idle)
+
+    @staticmethod
+    def _display_key(api_key: typing.Optional[str]) -> str:
+        """
+        A shortened API key that is safe to expose in logs and metrics
+        """
+        return f"{api_key[:6]}..." if api_key else 'default'
+
+    def __len__(self):
+        return len(self._clients)
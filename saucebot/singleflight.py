@@ -0,0 +1,62 @@
+import asyncio
+import typing
+
+from saucebot import metrics
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into a single in-flight call
+    While a call is running, anyone else requesting the same key awaits its result (or exception) instead of
+    starting their own.
+    """
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name (str): Name of this group of calls, used to label its metrics
+        """
+        self.name = name
+        self._calls = {}  # type: typing.Dict[typing.Hashable, asyncio.Future]
+        self.coalesced = metrics.counter('saucebot_coalesced_calls_total', 'Calls served by an in-flight call',
+                                         group=name)
+        self._in_flight = metrics.gauge('saucebot_in_flight_calls', 'Calls currently in flight', group=name)
+
+    async def do(self, key: typing.Hashable, function: typing.Callable[..., typing.Awaitable], *args, **kwargs):
+        """
+        Run the coroutine function, or join an in-flight call with the same key
+        Args:
+            key (typing.Hashable): Key identifying identical calls
+            function (typing.Callable[..., typing.Awaitable]): Coroutine function to call
+            *args: Arguments passed to the function
+            **kwargs: Keyword arguments passed to the function
+
+        Returns:
+            The result of the call
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced.inc()
+        else:
+            future = asyncio.ensure_future(function(*args, **kwargs))
+            self._calls[key] = future
+            self._in_flight.set(len(self._calls))
+            future.add_done_callback(lambda f: self._done(key, f))
+
+        # Shielded, so one caller being cancelled doesn't cancel the call for everyone else waiting on it
+        return await asyncio.shield(future)
+
+    def _done(self, key: typing.Hashable, future: asyncio.Future) -> None:
+        del self._calls[key]
+        self._in_flight.set(len(self._calls))
+
+        # Every waiter may have been cancelled, in which case nobody else retrieves the exception and asyncio would
+        # complain that it was never retrieved; waiters still get it through their own shields
+        if not future.cancelled():
+            future.exception()
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        return key in self._calls
+
+    def __len__(self):
+        return len(self._calls)
@@ -0,0 +1,98 @@
+import logging
+import os
+import typing
+from collections import Counter
+
+from saucebot import metrics
+from saucebot.cluster import ENV_CLUSTER_ID
+from saucebot.config import config
+from saucebot.models.database import BotStatistics, SauceQueries
+
+
+class Statistics:
+    """
+    Incrementally maintained bot statistics
+    Counters are updated as events happen, so reading them is always constant time. Persistent counters are written
+    to the database as deltas, periodically and on shutdown.
+    Clustered counters only cover the guilds of the current process. When running as a cluster, each worker stores its
+    own count whenever statistics are flushed, and reads include the last known counts of every other worker.
+    """
+    PERSISTENT = ('query_count',)
+    CLUSTERED = ('guild_count', 'user_count')
+
+    def __init__(self):
+        self._values = Counter()  # type: typing.Counter[str]
+        self._pending = Counter()  # type: typing.Counter[str]
+        # Counts of the other workers in the cluster, as of the last flush
+        self._others = Counter()  # type: typing.Counter[str]
+        self._cluster_id = int(os.environ[ENV_CLUSTER_ID]) if ENV_CLUSTER_ID in os.environ else None
+        self._processes = config.getint('Cluster', 'processes', fallback=1)
+        self._loaded = False
+        self._log = logging.getLogger(__name__)
+
+    def get(self, name: str) -> int:
+        return self._values[name] + self._others[name]
+
+    def set(self, name: str, value: int) -> None:
+        self._values[name] = value
+        metrics.gauge('saucebot_statistic', 'Bot statistics', statistic=name).set(value)
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        self.set(name, self._values[name] + amount)
+        if name in self.PERSISTENT:
+            self._pending[name] += amount
+
+    async def load(self) -> None:
+        """
+        Load persistent counters from the database
+        The query count is seeded from the query log the first time the bot runs with statistics tracking.
+        """
+        for name in self.PERSISTENT:
+            value = await BotStatistics.load(name)
+            if value is None and name == 'query_count':
+                value = await BotStatistics.seed(name, await SauceQueries.count_total())
+
+            self.set(name, (value or 0) + self._pending[name])
+
+        self._loaded = True
+
+    async def flush(self) -> None:
+        """
+        Write pending changes to persistent counters to the database
+        """
+        if not self._loaded:
+            await self.load()
+
+        for name in self.PERSISTENT:
+            delta = self._pending[name]
+            if delta:
+                total = await BotStatistics.increment(name, delta)
+                self._pending[name] -= delta
+            else:
+                total = await BotStatistics.load(name) or 0
+
+            # Picks up changes made by any other processes sharing the database
+            self.set(name, total + self._pending[name])
+
+        if self._cluster_id is not None:
+            await self._sync_cluster()
+
+        self._log.debug(f"Flushed statistics: {dict(self._values)}")
+
+    async def _sync_cluster(self) -> None:
+        """
+        Store this worker's clustered counters, and fetch the counts of the rest of the cluster
+        Counters are only stored once they have been set, so a worker that is still connecting doesn't replace the
+        count it stored before it was restarted with zero. Until then, that stored count is used instead.
+        """
+        for name in self.CLUSTERED:
+            counted = name in self._values
+            if counted:
+                await BotStatistics.store(f"{name}:{self._cluster_id}", self._values[name])
+
+            values = await BotStatistics.cluster_values(name, self._processes)
+            self._others[name] = sum(v for cluster_id, v in values.items()
+                                     if cluster_id != self._cluster_id or not counted)
+
+
+stats = Statistics()
@@ -2,30 +2,49 @@
 # authors: Ethosa, FujiMakoto
 import io
 import re
-from base64 import b64encode
 from json import loads
+from tempfile import SpooledTemporaryFile
 
-from aiohttp import ClientSession
-from PIL import Image
+from aiohttp import ClientSession, FormData
+
+from saucebot.imaging import ImageProcessingError, image_pool
+
+
+class TraceMoeException(Exception):
+    pass
+
+
+class FileTooLargeException(TraceMoeException):
+    pass
 
 
 class ATraceMoe:
 
     DISCORD_IMAGE_URL_RE = re.compile(r'^https://cdn\.discordapp\.com/attachments/(\S)+\.(jpg|jpeg|png|webp|gif)$')
 
-    def __init__(self, loop, token=""):
+    def __init__(self, loop, token="", max_download_size=8388608, spool_threshold=1048576, session=None,
+                 max_edge=0, quality=85):
         """
         Initialize trace moe API.
+
+        Keyword Arguments:
+            token {str} -- trace.moe API token (default: {""})
+            session {ClientSession} -- shared session to send requests through; must raise for status (default: {None})
+            max_download_size {int} -- previews larger than this many bytes are aborted (default: {8 MiB})
+            spool_threshold {int} -- previews larger than this many bytes are buffered on disk (default: {1 MiB})
+            max_edge {int} -- uploaded images are downscaled to fit within this many pixels, 0 to disable (default: {0})
+            quality {int} -- JPEG quality of downscaled images (default: {85})
         """
         self.api_url = "https://trace.moe/api/"
         self.main_url = "https://trace.moe/"
         self.media_url = "https://media.trace.moe/"
         self.token = token
-        self.session = ClientSession(
+        self.max_download_size = max_download_size
+        self.spool_threshold = spool_threshold
+        self.max_edge = max_edge
+        self.quality = quality
+        self.session = session or ClientSession(
                 loop=loop,
-                headers={
-                    "Content-Type": "application/json"
-                },
                 raise_for_status=True
         )
 
@@ -45,6 +64,36 @@ class ATraceMoe:
 
         return await response.json()
 
+    async def _download(self, url):
+        """
+        Streams a download into a spooled temporary file, aborting once it exceeds the maximum download size.
+
+        Arguments:
+            url {str} -- url to download
+
+        Raises:
+            FileTooLargeException -- the file is larger than the maximum download size
+
+        Returns:
+            SpooledTemporaryFile -- the downloaded file, rewound to the start
+        """
+        async with self.session.get(url) as response:
+            if response.content_length and response.content_length > self.max_download_size:
+                raise FileTooLargeException("%s is %d bytes" % (url, response.content_length))
+
+            file = SpooledTemporaryFile(max_size=self.spool_threshold)
+            size = 0
+            async for chunk in response.content.iter_chunked(65536):
+                size += len(chunk)
+                if size > self.max_download_size:
+                    file.close()
+                    raise FileTooLargeException("%s exceeds %d bytes" % (url, self.max_download_size))
+
+                file.write(chunk)
+
+        file.seek(0)
+        return file
+
     async def image_preview(self, response, index=0, page="thumbnail.php"):
         """
         Gets image preview after server response.
@@ -53,16 +102,15 @@ class ATraceMoe:
             response {dict} -- server response
 
         Returns:
-            bytes -- content for the write-in file.
+            SpooledTemporaryFile -- content for the write-in file.
         """
         response = response["docs"][index]
         url = "%s%s?anilist_id=%s&file=%s&t=%s&token=%s" % (
             self.main_url, page, response["anilist_id"],
             response["filename"], response["at"], response["tokenthumb"]
         )
-        response = await self.session.get(url)
 
-        return await response.content.read()
+        return await self._download(url)
 
     async def video_preview(self, response, index=0):
         """
@@ -72,7 +120,7 @@ class ATraceMoe:
             response {dict} -- server response
 
         Returns:
-            bytes -- content for the write-in file.
+            SpooledTemporaryFile -- content for the write-in file.
         """
         return await self.image_preview(response, index, "preview.php")
 
@@ -88,7 +136,7 @@ class ATraceMoe:
             mute {bool} -- mute video sound. {default: {False}}
 
         Returns:
-            bytes -- content for the write-in file.
+            SpooledTemporaryFile -- content for the write-in file.
         """
         response = response["docs"][index]
         url = "%svideo/%s/%s?t=%s&token=%s" % (
@@ -100,9 +148,7 @@ class ATraceMoe:
         if mute:
             url += "&mute"
 
-        response = await self.session.get(url)
-
-        return await response.content.read()
+        return await self._download(url)
 
     async def search(self, path, search_filter=0, is_url=False):
         """
@@ -125,41 +171,68 @@ class ATraceMoe:
         if is_url:
             # Discord URL's tend to break with trace.moe at the moment
             if self.DISCORD_IMAGE_URL_RE.match(path):
-                # Load the image
-                response = await self.session.get(path, read_until_eof=False)
-                data = io.BytesIO(await response.read())
-
-                # Verify it's a valid image first
-                image = Image.open(data)
-                image.verify()
-                image = Image.open(data)
-
-                # If it's an animated gif, we need to extract a frame
-                if hasattr(image, 'is_animated') and image.is_animated:
-                    data = io.BytesIO()
-                    image.seek(0)
-                    image.save(data, format='PNG')
-
-                del image
-                encoded = b64encode(data.getvalue()).decode("utf-8")
-                response = await self.session.post(
-                        url, json={"image": encoded, "filter": search_filter}
-                )
+                async with self.session.get(path) as response:
+                    data = await response.read()
+
+                return await self._upload(url, await self._prepare_image(data), search_filter)
             else:
                 response = await self.session.get(
                     url, params={"url": path}
                 )
             return loads(await response.text())
         elif isinstance(path, io.BufferedIOBase):
-            encoded = b64encode(path.read()).decode("utf-8")
-            response = await self.session.post(
-                url, json={"image": encoded, "filter": search_filter}
-            )
-            return loads(await response.text())
+            return await self._upload(url, path, search_filter)
         else:
             with open(path, "rb") as f:
-                encoded = b64encode(f.read()).decode("utf-8")
-            response = await self.session.post(
-                url, json={"image": encoded, "filter": search_filter}
-            )
-            return loads(await response.text())
\ No newline at end of file
+                return await self._upload(url, f, search_filter)
+
+    async def _prepare_image(self, data):
+        """
+        Checks that downloaded data is a valid image from its headers alone, then downscales it (or, if downscaling
+        is disabled, extracts the first frame of animated images). The image is processed in the image worker pool,
+        off the event loop.
+
+        Arguments:
+            data {bytes} -- raw image data
+
+        Raises:
+            TraceMoeException -- the data is not a supported image
+
+        Returns:
+            typing.BinaryIO -- the image to upload
+        """
+        try:
+            image_format, animated = await image_pool.identify(data)
+            if image_format not in ("JPEG", "PNG", "GIF", "WEBP"):
+                raise TraceMoeException("Unsupported image format: %s" % image_format)
+
+            # trace.moe only needs a small copy of the image, and only the first frame of animated images
+            if self.max_edge:
+                data = await image_pool.downscale(data, self.max_edge, self.quality)
+            elif animated:
+                data = await image_pool.first_frame(data)
+        except ImageProcessingError as e:
+            raise TraceMoeException(str(e))
+
+        return io.BytesIO(data)
+
+    async def _upload(self, url, fh, search_filter=0):
+        """
+        Uploads an image to the search API as multipart form data, streaming it from the file handle.
+
+        Arguments:
+            url {str} -- search endpoint
+            fh {typing.BinaryIO} -- image file
+
+        Keyword Arguments:
+            search_filter {int} -- anilist ID to restrict the search to (default: {0})
+
+        Returns:
+            dict -- server response
+        """
+        form = FormData()
+        form.add_field("image", fh, filename="image")
+        form.add_field("filter", str(search_filter))
+
+        async with self.session.post(url, data=form) as response:
+            return loads(await response.text())
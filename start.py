@@ -1,4 +1,13 @@
 from saucebot.config import config
-from saucebot.saucebot import bot
 
-bot.run(config.get('Discord', 'token'))
+if __name__ == '__main__':
+    processes = config.getint('Cluster', 'processes', fallback=1)
+    if processes > 1:
+        from saucebot.cluster import ClusterSupervisor
+        from saucebot.log import log
+
+        ClusterSupervisor(config.get('Discord', 'token'), processes, config.getint('Cluster', 'shard_count', fallback=0),
+                          config.getfloat('Cluster', 'restart_delay', fallback=5.0)).run()
+    else:
+        from saucebot.saucebot import bot
+        bot.run(config.get('Discord', 'token'))